@@ -1,6 +1,8 @@
 import six
 
 from datetime import date
+from functools import partial
+from koert.gnucash.core import AccountDay, day_ordinal
 
 
 def check_split_direction(book, split):
@@ -25,10 +27,25 @@ def check_tr_period(book, tr):
     return tr.date_posted.date < start or tr.date_posted.date > end
 
 
+def prepare_tr_period(book):
+    start = book.meta['period']['from']
+    end = book.meta['period']['to']
+
+    def check(tr):
+        day = tr.date_posted.date
+        return day < start or day > end
+    return check
+
+
 def check_tr_in_future(book, tr):
     return tr.date_posted.date > date.today()
 
 
+def prepare_tr_in_future(book):
+    today = date.today()
+    return lambda tr: tr.date_posted.date > today
+
+
 def check_tr_has_number(book, tr):
     return tr.num is None
 
@@ -36,23 +53,19 @@ def check_tr_has_number(book, tr):
 def check_tr_unique_number(book, tr):
     return len(book.trs_by_num[tr.num]) != 1
 
+
+def prepare_tr_unique_number(book):
+    trs_by_num = book.trs_by_num
+    return lambda tr: len(trs_by_num[tr.num]) != 1
+
+
 def check_tr_census(book, tr):
     if not tr.is_census or tr.census==None:
         return False
     for sp in six.itervalues(tr.splits):
-        ad = sp.account.days[tr.day]
-        if ad.starting_balance == tr.census or ad.ending_balance == tr.census:
-            return False
         # perhaps the desired number appears in the middle of the day
-        total = ad.starting_balance
-        trs = list(ad.transactions)
-        trs.sort(key=lambda tr: tr.num)
-        for tr_ in trs:
-            for sp_ in six.itervalues(tr_.splits):
-                if sp_.account == sp.account:
-                    total += sp_.value
-                if total == tr.census:
-                    return False
+        if tr.census in sp.account.days[tr.day].balances:
+            return False
     return True
 
 def check_tr_census_wellformed(book, tr):
@@ -64,20 +77,300 @@ def check_day_balance_sign(book, day):
     return day.ending_balance * day.account.balance_sign < 0
 
 
-def check_all(book, names=()):
-    for check in CHECKS:
-        if len(names)>0 and check['name'] not in names:
-            continue
-        for obj in _CHECK_ALL_SWITCH[check['per']](book, check):
+# When previous, an earlier version of the book which has been marked
+# (see mark_all), is given, only the objects affected by the changes
+# since are checked, and the other objects get the results of their
+# counterparts in previous (see Counterparts).
+def check_all(book, names=(), previous=None):
+    checks = [check for check in CHECKS
+              if len(names)==0 or check['name'] in names]
+    for check, objs in run_checks(book, checks, previous):
+        for obj in objs:
             yield {'object': obj, 'check': check}
 
-def mark_all(book):
+# When workers is given, and previous is not, the checks are run by
+# run_checks_parallel instead.
+def mark_all(book, previous=None, workers=None, threads=False):
+    # (a book that was marked before loses its old marks)
+    for data in six.itervalues(book.checks):
+        for obj in data['objects']:
+            del obj.checks[:]
     for check in CHECKS:
         book.checks[check['name']] = { 'check': check, 'objects':[] }
-    for result in check_all(book):
+    if workers is not None and previous is None:
+        results = ({'object': obj, 'check': check} for check, objs
+                   in run_checks_parallel(book, CHECKS, workers, threads)
+                   for obj in objs)
+    else:
+        results = check_all(book, previous=previous)
+    for result in results:
         result['object'].checks.append(result['check'])
         book.checks[result['check']['name']]['objects'].append(result['object'])
 
+# Runs the checks over the book in one pass:  every transaction (with
+# its splits) and every account-day is visited once, and given to all
+# checks of its kind.  Returns, for each check in order, the check and
+# the list of objects that fail it, in the order check_all_splits etc.
+# would have found them.  (For previous, see check_all.)
+def run_checks(book, checks=None, previous=None):
+    if checks is None:
+        checks = CHECKS
+    counterparts = None
+    # (the marks of book itself are being replaced, so can not be reused)
+    if previous is not None and previous is not book and previous.checks:
+        counterparts = Counterparts.between(book, previous)
+    days = (day for ac in six.itervalues(book.accounts)
+            for day in six.itervalues(ac.days))
+    return _run_checks(book, checks, six.itervalues(book.transactions),
+                       days, counterparts)
+
+def _run_checks(book, checks, trs, days, counterparts=None):
+    funcs = dict((per, []) for per in _CHECK_ALL_SWITCH)
+    results = []
+    for check in checks:
+        objs = []
+        funcs[check['per']].append((prepare_check(book, check), objs,
+                                    None if check.get('volatile') else check))
+        results.append((check, objs))
+    tr_funcs = funcs['transaction']
+    sp_funcs = funcs['split']
+    day_funcs = funcs['account-day']
+    if tr_funcs or sp_funcs:
+        for tr in trs:
+            old = None
+            if counterparts is not None:
+                old = counterparts.transaction(tr)
+            _apply(tr_funcs, tr, old)
+            if not sp_funcs:
+                continue
+            for split in six.itervalues(tr.splits):
+                _apply(sp_funcs, split,
+                       None if old is None else old.splits.get(split.id))
+    if day_funcs:
+        for day in days:
+            old = None
+            if counterparts is not None:
+                old = counterparts.day(day)
+            _apply(day_funcs, day, old)
+    return results
+
+# Runs the checks like run_checks, but divides the transactions (with
+# their splits) and the account-days in chunks over a pool of workers
+# (by default one per cpu), processes or, when threads is set, threads.
+# The processes are not sent the book itself, but load it from a
+# snapshot (see gnucash.snapshot), and send back the GUIDs of the objects
+# that fail.  The results are put together in the order of the chunks,
+# so they are the same as those of run_checks.
+def run_checks_parallel(book, checks=None, workers=None, threads=False):
+    import os
+    if checks is None:
+        checks = CHECKS
+    checks = list(checks)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    trs = list(six.itervalues(book.transactions))
+    days = [day for ac in six.itervalues(book.accounts)
+            for day in six.itervalues(ac.days)]
+    tr_chunks = _chunks(trs, workers * 4)
+    day_chunks = _chunks(days, workers * 4)
+    if threads:
+        from concurrent.futures import ThreadPoolExecutor
+        # so that the threads do not build them at the same time
+        book.trs_by_num
+        for day in days:
+            day.balances
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(
+                lambda chunk: _run_checks(book, checks, chunk, ()),
+                tr_chunks))
+            parts += executor.map(
+                lambda chunk: _run_checks(book, checks, (), chunk),
+                day_chunks)
+        return _merge_parts(checks, parts)
+    from concurrent.futures import ProcessPoolExecutor
+    from koert.gnucash import snapshot
+    from koert.gnucash.core import File
+    import tempfile
+    fd, path = tempfile.mkstemp(suffix=".snapshot")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            snapshot.dump(File({'books': {book.id: book}}), f)
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(path, _book_state(book))) \
+                as executor:
+            tasks = [([tr.id for tr in chunk], ()) for chunk in tr_chunks]
+            tasks += [((), [(day.account.id, day.day) for day in chunk])
+                      for chunk in day_chunks]
+            keyed = executor.map(_check_in_worker,
+                                 [(checks, tr_ids, day_keys)
+                                  for tr_ids, day_keys in tasks])
+            objs = book.obj_by_id
+            parts = []
+            for part in keyed:
+                parts.append([(check, [
+                    book.accounts[key[0]].days[key[1]]
+                    if isinstance(key, tuple) else objs[key]
+                    for key in keys]) for check, keys in zip(checks, part)])
+    finally:
+        os.remove(path)
+    return _merge_parts(checks, parts)
+
+def _chunks(objs, count):
+    size = max(1, -(-len(objs) // count))
+    return [objs[i:i + size] for i in range(0, len(objs), size)]
+
+def _merge_parts(checks, parts):
+    results = [(check, []) for check in checks]
+    for part in parts:
+        for (check, objs), (_, part_objs) in zip(results, part):
+            objs.extend(part_objs)
+    return results
+
+# What open_yaml sets on a book after it has been parsed, and which is
+# therefore not in its snapshot.
+def _book_state(book):
+    return {
+        'meta': getattr(book, 'meta', None),
+        'opening': [ac.id for ac in six.itervalues(book.accounts)
+                    if ac.is_opening_balance],
+        'census': dict((tr.id, tr.census)
+                       for tr in six.itervalues(book.transactions)
+                       if tr.is_census),
+    }
+
+_worker_book = None
+
+def _init_worker(path, state):
+    global _worker_book
+    from koert.gnucash import snapshot
+    with open(path, "rb") as f:
+        book = snapshot.load(f).book
+    if state['meta'] is not None:
+        book.meta = state['meta']
+    for ac_id in state['opening']:
+        book.accounts[ac_id].is_opening_balance = True
+    for tr_id, census in six.iteritems(state['census']):
+        tr = book.transactions[tr_id]
+        tr.is_census = True
+        tr.census = census
+    _worker_book = book
+
+def _check_in_worker(task):
+    checks, tr_ids, day_keys = task
+    book = _worker_book
+    trs = [book.transactions[tr_id] for tr_id in tr_ids]
+    days = [book.accounts[ac_id].days[day] for ac_id, day in day_keys]
+    return [[_key(obj) for obj in objs]
+            for check, objs in _run_checks(book, checks, trs, days)]
+
+def _key(obj):
+    if isinstance(obj, AccountDay):
+        return (obj.account.id, obj.day)
+    return obj.id
+
+# Adds obj to the objs of the funcs it fails;  when obj has an unchanged
+# counterpart old, the results of old are used instead for all but the
+# volatile checks.
+def _apply(funcs, obj, old):
+    for func, objs, check in funcs:
+        if old is not None and check is not None:
+            failed = any(c is check for c in old.checks)
+        else:
+            failed = func(obj)
+        if failed:
+            objs.append(obj)
+
+# Returns check['func'] for the book as a function of the object only;
+# checks with a 'prepare' compute what does not depend on the object
+# once, beforehand.
+def prepare_check(book, check):
+    if 'prepare' in check:
+        return check['prepare'](book)
+    return partial(check['func'], book)
+
+class Counterparts(object):
+    """Finds for the objects of a book the objects of an earlier version
+    of the book that have the same check results, by GUID.
+
+    These are all objects except the transactions (and their splits)
+    that changed, were added, share their number with such a transaction
+    (see E04), or are a census with an affected account-day (see E05);
+    and except the account-days on or after a day on which a changed
+    transaction was (or is) posted to the account, because their
+    balances may have shifted.  When the accounts or the meta data of
+    the book differ, there are no counterparts at all."""
+
+    def __init__(self, previous, changed, nums, days):
+        self.previous = previous
+        # ids of changed transactions, and their old and new numbers
+        self.changed = changed
+        self.nums = nums
+        # account id to ordinal of the first affected day
+        self.days = days
+
+    @classmethod
+    def between(cls, book, previous):
+        if getattr(book, 'meta', None) != getattr(previous, 'meta', None):
+            return None
+        if _accounts_signature(book) != _accounts_signature(previous):
+            return None
+        changed = set()
+        for tr in six.itervalues(book.transactions):
+            old = previous.transactions.get(tr.id)
+            if old is None or _tr_signature(old) != _tr_signature(tr):
+                changed.add(tr.id)
+        for tr_id in previous.transactions:
+            if tr_id not in book.transactions:
+                changed.add(tr_id)
+        nums = set()
+        days = dict()
+        for tr_id in changed:
+            for trs in (previous.transactions, book.transactions):
+                tr = trs.get(tr_id)
+                if tr is None:
+                    continue
+                nums.add(tr.num)
+                ordinal = day_ordinal(tr.day)
+                for sp in six.itervalues(tr.splits):
+                    if ordinal < days.get(sp.account_id, ordinal + 1):
+                        days[sp.account_id] = ordinal
+        return cls(previous, changed, nums, days)
+
+    def day_affected(self, account_id, day):
+        first = self.days.get(account_id)
+        return first is not None and day_ordinal(day) >= first
+
+    def transaction(self, tr):
+        if tr.id in self.changed or tr.num in self.nums:
+            return None
+        if tr.is_census:
+            for sp in six.itervalues(tr.splits):
+                if self.day_affected(sp.account_id, tr.day):
+                    return None
+        return self.previous.transactions.get(tr.id)
+
+    def day(self, day):
+        ac_id = day.account.id
+        if self.day_affected(ac_id, day.day):
+            return None
+        return self.previous.accounts[ac_id].days.get(day.day)
+
+
+def _accounts_signature(book):
+    return dict((ac.id, (ac.name, ac.parent_id, ac.type,
+                         ac.is_opening_balance))
+                for ac in six.itervalues(book.accounts))
+
+
+def _tr_signature(tr):
+    return (tr.num, tr.description, tr.day,
+            tr.date_posted.timestamp, tr.is_census, tr.census,
+            sorted((sp.id, sp.account_id, sp.value.as_tuple(),
+                    sp.quantity.as_tuple(), sp.memo, sp.reconciled_state)
+                   for sp in six.itervalues(tr.splits)))
+
+
 def check_all_splits(book, check):
     for tr in six.itervalues(book.transactions):
         for split in six.itervalues(tr.splits):
@@ -136,6 +429,7 @@ CHECKS = [
     {
         'name': "E03",
         'func': check_tr_period,
+        'prepare': prepare_tr_period,
         'description': "Not in booking period!",
         'type': "error",
         "per": "transaction"
@@ -143,6 +437,9 @@ CHECKS = [
     {
         'name': "W03",
         'func': check_tr_in_future,
+        'prepare': prepare_tr_in_future,
+        # depends on the day it is run
+        'volatile': True,
         'description': "In the future?",
         'type': "warning",
         "per": "transaction"
@@ -157,6 +454,7 @@ CHECKS = [
     {
         'name': "E04",
         'func': check_tr_unique_number,
+        'prepare': prepare_tr_unique_number,
         'description': "Another transaction has the same number!",
         'type': "error",
         "per": "transaction"
@@ -1,6 +1,8 @@
+import six
 from decimal import Decimal
+from koert.gnucash.core import from_units
 
-# Returns the transactions
+# Returns the transactions, in the order they were posted,
 #       from    only this account (or its subaccounts) if specified
 # in the period
 #       begin   -ing at this date if provided and
@@ -12,22 +14,60 @@ from decimal import Decimal
 
 
 def get_trs(book, _from=None, begin=None, end=None):
-    trs = set()
     if not _from:
-        _from = book.root
-    for tr in _from.get_deep_trs():
-        if not tr_in_period(tr, begin, end):
-            continue
-        trs.add(tr)
-    return trs
+        return book.trs_by_date.between(begin, end)
+    return _from.deep_trs_by_date.between(begin, end)
 
 # Given a set of transactions from *get_trs* specified by kwargs,
 # returns the _flow_ to each account,
 # which is the sum of the amounts of the mutations of this account.
 
 
-def get_flow(book, **kwargs):
-    return get_flow_from_trs(book, get_trs(book, **kwargs))
+def get_flow(book, _from=None, begin=None, end=None):
+    cols = book.columns()
+    where = cols.in_period(begin, end)
+    if _from:
+        where = cols.both(where, cols.touching(_from))
+    sides = []
+    for negative in (False, True):
+        side = cols.both(where, cols.by_sign(negative))
+        units = cols.roll_up(cols.sum_by_account(cols.value, side))
+        exps = cols.roll_up(cols.min_by_account(cols.value_exp, side),
+                            minimum=True)
+        sides.append(cols.to_decimals(units, exps))
+    flow = {}
+    for i, ac in enumerate(cols.accounts):
+        flow[ac] = [sides[0][i], sides[1][i]]
+    return flow
+
+# Returns the flows (see get_flow) to each account in several periods
+# at once:  given increasing timestamps *boundaries*, period i runs from
+# boundaries[i] up to (but not including) boundaries[i+1], and the flow
+# to an account is a list with the [debit, credit] of each period.
+# As with get_flow, only the transactions touching *_from* count when
+# it is given.
+
+
+def get_flows_by_period(book, boundaries, _from=None):
+    cols = book.columns()
+    nperiods = max(len(boundaries) - 1, 0)
+    periods = cols.periods(boundaries)
+    where = cols.touching(_from) if _from else None
+    sides = []
+    for negative in (False, True):
+        side = cols.by_sign(negative)
+        if where is not None:
+            side = cols.both(where, side)
+        units = cols.roll_up(cols.sum_by_account(
+            cols.value, side, periods, nperiods))
+        exps = cols.roll_up(cols.min_by_account(
+            cols.value_exp, side, periods, nperiods), minimum=True)
+        sides.append(cols.to_decimals(units, exps))
+    flows = {}
+    for i, ac in enumerate(cols.accounts):
+        flows[ac] = [[debit, credit] for debit, credit
+                     in zip(sides[0][i], sides[1][i])]
+    return flows
 
 # Returns the balance of each account at a given date,
 # which is the flow to that account upto the given date.
@@ -62,6 +102,8 @@ def get_flow_from_trs(book, trs):
 
 
 def get_flow_from_muts(book, muts):
+    if book.scale is not None:
+        return get_flow_from_muts_scaled(book, muts)
     flow = {}
     for ac in list(book.accounts.values()):
         flow[ac] = [Decimal(0), Decimal(0)]
@@ -76,3 +118,23 @@ def get_flow_from_muts(book, muts):
                 flow[ac][1] += val
             ac = ac.parent
     return flow
+
+
+# get_flow_from_muts for a book in scaled-integer mode (see
+# Book.use_scaled_ints);  the sums are None until a value is added.
+def get_flow_from_muts_scaled(book, muts):
+    flow = {}
+    for ac in list(book.accounts.values()):
+        flow[ac] = [None, None]
+    for mut in muts:
+        ac = mut.account
+        units = mut.units
+        side = 0 if units >= 0 else 1
+        while ac is not None:
+            total = flow[ac][side]
+            flow[ac][side] = units if total is None else total + units
+            ac = ac.parent
+    for sums in six.itervalues(flow):
+        sums[0] = from_units(sums[0], book.scale)
+        sums[1] = from_units(sums[1], book.scale)
+    return flow
@@ -0,0 +1,274 @@
+"""A columnar view on the splits of a book (see Book.columns).
+
+Each split is a row; the columns are
+
+    account      index of the split's account in Columns.accounts
+    transaction  index of the split's transaction in Columns.transactions
+    day          ordinal (see date.toordinal) of the day it was posted
+    posted       timestamp of the moment it was posted
+    value        the value in units of 10**value_scale
+    value_exp    the exponent of the value as a Decimal
+    quantity     the quantity in units of 10**quantity_scale
+    reconciled   the reconciled state ('n', 'c' or 'y')
+
+and Columns.parent gives the index of the parent of each account
+(or -1 for the root).  The columns are numpy arrays when numpy can be
+imported and lists otherwise;  the helpers below work on both.
+
+Amounts are summed as ints and turned into Decimals by to_decimals,
+which needs, next to the sum, the least exponent of its terms (see
+min_by_account) to give the same Decimal as adding up the values would.
+"""
+
+from bisect import bisect_right
+from decimal import Decimal
+import six
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Columns(object):
+
+    def __init__(self, book):
+        self.accounts = list(book.accounts.values())
+        self.account_index = index = dict(
+            (ac.id, i) for i, ac in enumerate(self.accounts))
+        parent = [-1 if ac.parent is None else index[ac.parent.id]
+                  for ac in self.accounts]
+        depth = []
+        for ac in self.accounts:
+            d = 0
+            while ac.parent is not None:
+                ac = ac.parent
+                d += 1
+            depth.append(d)
+        # the accounts, children before their parents
+        self._bottom_up = sorted(range(len(parent)), key=lambda i: -depth[i])
+        self.transactions = list(book.transactions.values())
+
+        account = []
+        transaction = []
+        day = []
+        posted = []
+        values = []
+        quantities = []
+        reconciled = []
+        for j, tr in enumerate(self.transactions):
+            ordinal = tr.date_posted.date.toordinal()
+            timestamp = tr.date_posted.timestamp
+            for sp in six.itervalues(tr.splits):
+                account.append(index[sp.account_id])
+                transaction.append(j)
+                day.append(ordinal)
+                posted.append(timestamp)
+                values.append(sp.value)
+                quantities.append(sp.quantity)
+                reconciled.append(sp.reconciled_state)
+
+        value_exp = [v.as_tuple()[2] for v in values]
+        if book.scale is not None:
+            self.value_scale = book.scale
+            value = [sp.units for tr in self.transactions
+                     for sp in six.itervalues(tr.splits)]
+        else:
+            self.value_scale, value = _scaled(values, value_exp)
+        self.quantity_scale, quantity = _scaled(
+            quantities, [q.as_tuple()[2] for q in quantities])
+
+        self.parent = _column(parent)
+        self.account = _column(account)
+        self.transaction = _column(transaction)
+        self.day = _column(day)
+        self.posted = _column(posted, "float64")
+        self.value = _column(value)
+        self.value_exp = _column(value_exp)
+        self.quantity = _column(quantity)
+        if numpy is not None:
+            reconciled = numpy.array(reconciled, dtype="U1")
+        self.reconciled = reconciled
+
+    def __len__(self):
+        return len(self.account)
+
+    # ############# selections ############################################
+    # A selection of splits is a column of bools.
+
+    def everything(self):
+        if numpy is not None:
+            return numpy.ones(len(self), dtype=bool)
+        return [True] * len(self)
+
+    # the splits posted between begin and end (both timestamps,
+    # both inclusive, and both optional, like balance.tr_in_period)
+    def in_period(self, begin=None, end=None):
+        posted = self.posted
+        if numpy is not None:
+            where = self.everything()
+            if end:
+                where &= posted <= end
+            if begin:
+                where &= posted >= begin
+            return where
+        return [not ((end and p > end) or (begin and p < begin))
+                for p in posted]
+
+    # the splits whose value is at least zero (debit), or, when
+    # negative is set, below zero (credit)
+    def by_sign(self, negative=False):
+        if numpy is not None:
+            return self.value < 0 if negative else self.value >= 0
+        return [(v < 0) == negative for v in self.value]
+
+    # the splits of the transactions that have a split in account
+    # or one of its descendants (see Account.get_deep_trs)
+    def touching(self, account):
+        inside = [False] * len(self.accounts)
+        for desc in account.get_descendants():
+            inside[self.account_index[desc.id]] = True
+        if numpy is not None:
+            inside = numpy.array(inside, dtype=bool)
+            touched = numpy.zeros(len(self.transactions), dtype=bool)
+            touched[self.transaction[inside[self.account]]] = True
+            return touched[self.transaction]
+        touched = set(tr for ac, tr in zip(self.account, self.transaction)
+                      if inside[ac])
+        return [tr in touched for tr in self.transaction]
+
+    @staticmethod
+    def both(where, other):
+        if numpy is not None:
+            return where & other
+        return [a and b for a, b in zip(where, other)]
+
+    # ############# group-by ##############################################
+
+    # The index of the period of each split, given the increasing
+    # timestamps boundaries: period i runs from boundaries[i] up to
+    # (but not including) boundaries[i+1];  splits outside all periods
+    # get -1.
+    def periods(self, boundaries):
+        last = len(boundaries) - 1
+        if numpy is not None:
+            period = numpy.searchsorted(
+                numpy.asarray(boundaries, dtype="float64"),
+                self.posted, side="right") - 1
+            period[period >= last] = -1
+            return period
+        result = []
+        for p in self.posted:
+            i = bisect_right(boundaries, p) - 1
+            result.append(i if i < last else -1)
+        return result
+
+    # Sums column per account over the selected splits.  When periods
+    # (see above) is given, the result has a row per account and a
+    # column per period instead.
+    def sum_by_account(self, column, where=None, periods=None, nperiods=0):
+        return self._by_account(column, where, periods, nperiods, _SUM)
+
+    # The least of 0 and the entries of column per account over the
+    # selected splits (with the same periods as sum_by_account).
+    def min_by_account(self, column, where=None, periods=None, nperiods=0):
+        return self._by_account(column, where, periods, nperiods, _MIN)
+
+    def _by_account(self, column, where, periods, nperiods, op):
+        n = len(self.accounts)
+        if numpy is not None:
+            groups = self.account
+            if periods is not None:
+                groups = groups * nperiods + periods
+                inside = periods >= 0
+                where = inside if where is None else where & inside
+            if where is not None:
+                column = column[where]
+                groups = groups[where]
+            size = n * nperiods if periods is not None else n
+            result = numpy.zeros(size, dtype=column.dtype)
+            (numpy.add if op is _SUM else numpy.minimum).at(
+                result, groups, column)
+            if periods is not None:
+                result = result.reshape((n, nperiods))
+            return result
+        if periods is None:
+            result = [0] * n
+            rows = zip(self.account, column)
+        else:
+            result = [[0] * nperiods for i in range(n)]
+            rows = zip(self.account, periods, column)
+        for i, row in enumerate(rows):
+            if where is not None and not where[i]:
+                continue
+            if periods is None:
+                result[row[0]] = op(result[row[0]], row[1])
+            elif row[1] >= 0:
+                ac, period, value = row
+                result[ac][period] = op(result[ac][period], value)
+        return result
+
+    # Adds the result of sum_by_account (or, with minimum set, combines
+    # the result of min_by_account) of each account to those of its
+    # ancestors, giving the totals per subtree.
+    def roll_up(self, per_account, minimum=False):
+        combine = _MIN if minimum else _SUM
+        if numpy is not None:
+            per_account = per_account.copy()
+            ufunc = numpy.add if combine is _SUM else numpy.minimum
+            for i in self._bottom_up:
+                p = self.parent[i]
+                if p >= 0:
+                    per_account[p] = ufunc(per_account[p], per_account[i])
+            return per_account
+        per_account = [list(row) if isinstance(row, list) else row
+                       for row in per_account]
+        for i in self._bottom_up:
+            p = self.parent[i]
+            if p < 0:
+                continue
+            if isinstance(per_account[i], list):
+                per_account[p] = [combine(a, b) for a, b
+                                  in zip(per_account[p], per_account[i])]
+            else:
+                per_account[p] = combine(per_account[p], per_account[i])
+        return per_account
+
+    # Turns sums of values (see sum_by_account) into Decimals, given the
+    # least exponents of their terms (see min_by_account).
+    def to_decimals(self, units, exps):
+        return [self.to_decimals(u, e) if _is_row(u)
+                else to_decimal(int(u), self.value_scale, int(e))
+                for u, e in zip(units, exps)]
+
+
+def to_decimal(units, scale, exp):
+    return Decimal(units).scaleb(scale).quantize(Decimal(1).scaleb(exp))
+
+
+def _is_row(x):
+    return isinstance(x, list) or getattr(x, "ndim", 0) > 0
+
+
+def _SUM(a, b):
+    return a + b
+
+
+def _MIN(a, b):
+    return a if a < b else b
+
+
+# Scales the Decimals ds, with exponents exps, to ints in units of
+# 10**scale, with scale the least exponent;  returns scale and the ints.
+def _scaled(ds, exps):
+    scale = min(exps) if exps else 0
+    return scale, [int(d.scaleb(-scale)) for d in ds]
+
+
+def _column(values, dtype="int64"):
+    if numpy is None:
+        return values
+    try:
+        return numpy.array(values, dtype=dtype)
+    except OverflowError:
+        return numpy.array(values, dtype=object)
@@ -1,19 +1,80 @@
 import six
-from datetime import datetime
+from bisect import bisect_left, bisect_right
+import heapq
+from itertools import repeat
+from datetime import date, datetime
 from decimal import Decimal
 import re
+from .columns import Columns
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 
 class GcStruct(object):
 
+    __slots__ = ()
+
+    # The numerous objects (accounts, transactions, splits, ...) keep
+    # their fields in slots:  FIELDS lists the pairs (field, attribute).
+    # Their  fields  is a FieldsView on these attributes.
+    # The other objects (files and books) keep the dict they are given.
+    FIELDS = None
+
     def __init__(self, fields):
-        self.fields = fields
+        if self.FIELDS is None:
+            self.__dict__['fields'] = fields
+            return
+        for field, attr in self.FIELDS:
+            setattr(self, attr, fields[field])
+
+    @property
+    def fields(self):
+        if self.FIELDS is None:
+            return self.__dict__['fields']
+        return FieldsView(self)
+
+
+_field_attrs = dict()
+
+
+class FieldsView(Mapping):
+
+    __slots__ = ('_obj', '_attrs')
+
+    def __init__(self, obj):
+        self._obj = obj
+        cls = type(obj)
+        if cls not in _field_attrs:
+            _field_attrs[cls] = dict(cls.FIELDS)
+        self._attrs = _field_attrs[cls]
+
+    def __getitem__(self, field):
+        return getattr(self._obj, self._attrs[field])
+
+    def __setitem__(self, field, value):
+        setattr(self._obj, self._attrs[field], value)
+
+    def __iter__(self):
+        return (field for field, attr in self._obj.FIELDS)
+
+    def __len__(self):
+        return len(self._obj.FIELDS)
+
+    def __repr__(self):
+        return repr(dict(self))
 
 
 class GcObj(GcStruct):
 
+    __slots__ = ('_checks', '_fingerprint')
+
     def __init__(self, fields):
         GcStruct.__init__(self, fields)
         self._checks = None
+        # see fingerprint.fingerprint
+        self._fingerprint = None
 
     @property
     def checks(self):
@@ -21,10 +82,6 @@ class GcObj(GcStruct):
             self._checks = []
         return self._checks
 
-    @property
-    def id(self):
-        return self.fields['id']
-
 
 class File(GcStruct):
 
@@ -45,11 +102,19 @@ class Book(GcObj):
     def __init__(self, fields):
         GcObj.__init__(self, fields)
         self._root = None
+        # see use_scaled_ints
+        self.scale = None
+        self._columns = None
+        self._trs_by_date = None
         self._set_account_refs()
         self._trs_by_num = None
         self._obj_by_id = None
         self._checks = {}
 
+    @property
+    def id(self):
+        return self.fields['id']
+
     def _set_account_refs(self):
         for ac in self.accounts.values():
             self._handle_account(ac)
@@ -73,15 +138,91 @@ class Book(GcObj):
                              "but it is not the root account" % ac)
 
     def _handle_transaction(self, tr):
+        self._columns = None
+        self._fingerprint = None
+        self._trs_by_date = None
         for sp in tr.splits.values():
             self._handle_split(sp, tr)
 
+    # adds a transaction parsed separately from the book
+    # (see tools.parallelparse)
+    def _add_transaction(self, tr):
+        if tr.id in self.transactions:
+            raise ValueError("book %s has two transactions with id %s"
+                             % (self, tr.id))
+        self.transactions[tr.id] = tr
+        self._handle_transaction(tr)
+
     def _handle_split(self, sp, tr):
-        sp._account = self.accounts[sp.account_id]
+        self._link_split(sp, tr)
+        if self.scale is not None:
+            if sp.value.as_tuple()[2] != self.scale:
+                self.use_decimals()
+            else:
+                sp.units = int(sp.value.scaleb(-self.scale))
+        ac = sp.account
+        ac._add_split(sp)
+        # (the index of an account is built from those of its children)
+        while ac is not None and ac._deep_trs is not None:
+            ac._deep_trs = None
+            ac = ac.parent
+        ac = sp.account
+        if tr.id not in ac._transactions_ids:
+            ac.transactions.append(tr)
+            ac._transactions_ids.add(tr.id)
+
+    # sets the references of the split without registering the
+    # transaction with the account (see also iter_gcf)
+    def _link_split(self, sp, tr):
+        # (this also makes the split share the account's id string)
+        sp.account = self.accounts[sp.account_id]
         sp._transaction = tr
-        if tr.id not in sp.account._transactions_ids:
-            sp.account.transactions.append(tr)
-            sp.account._transactions_ids.add(tr.id)
+
+    # In scaled-integer mode, the value of each split is also stored as
+    # an int, split.units, counting units of 10**scale, and the balances
+    # of the accounts are summed as ints and only turned into Decimals
+    # when they are asked for.  This is only possible when all values
+    # have the same exponent;  returns whether they have.
+    def use_scaled_ints(self):
+        if self.scale is not None:
+            return True
+        scale = None
+        for tr in six.itervalues(self.transactions):
+            for sp in six.itervalues(tr.splits):
+                exp = sp.value.as_tuple()[2]
+                if scale is None:
+                    scale = exp
+                elif exp != scale:
+                    return False
+        if scale is None:
+            return False
+        for tr in six.itervalues(self.transactions):
+            for sp in six.itervalues(tr.splits):
+                sp.units = int(sp.value.scaleb(-scale))
+        self._set_scale(scale)
+        return True
+
+    def use_decimals(self):
+        if self.scale is None:
+            return
+        for tr in six.itervalues(self.transactions):
+            for sp in six.itervalues(tr.splits):
+                sp.units = None
+        self._set_scale(None)
+
+    def _set_scale(self, scale):
+        self.scale = scale
+        self._columns = None
+        for ac in six.itervalues(self.accounts):
+            ac._scale = scale
+            ac._days = None
+            ac._timeline = None
+
+    # a view on the splits as columns, see columns.Columns
+    def columns(self):
+        if self._columns is None:
+            self._columns = Columns(self)
+        return self._columns
 
     def _handle_root_ac(self, ac):
         if ac.type != 'ROOT':
@@ -109,6 +250,15 @@ class Book(GcObj):
     def commodities(self):
         return self.fields['commodities']
 
+    # the transactions, sorted by the moment they were posted
+    @property
+    def trs_by_date(self):
+        if self._trs_by_date is None:
+            trs = sorted(six.itervalues(self.transactions),
+                         key=_tr_posted)
+            self._trs_by_date = TransactionsByDate(trs)
+        return self._trs_by_date
+
     @property
     def trs_by_num(self):
         if self._trs_by_num is None:
@@ -195,6 +345,14 @@ class Book(GcObj):
         return ()
 
 
+# Returns the ordinal (see date.toordinal) of the day "YYYY-MM-DD";
+# the opening day "" comes before all other days.
+def day_ordinal(day):
+    if day == "":
+        return 0
+    return date(int(day[0:4]), int(day[5:7]), int(day[8:10])).toordinal()
+
+
 ACCOUNT_SIGNS = {
     'CASH': {
         'balance': 1,
@@ -238,19 +396,43 @@ ACCOUNT_SIGNS = {
 @six.python_2_unicode_compatible
 class Account(GcObj):
 
+    __slots__ = ('name', 'id', 'type', 'parent_id', 'description', 'code',
+                 'commodity', 'commodity_scu',
+                 '_path', '_shortpath', '_shortname', '_days',
+                 '_day_list', '_day_ordinals', '_timeline', '_scale',
+                 '_deep_trs', '_subtree_fingerprint', '_parent',
+                 '_children', '_transactions', '_splits', '_splits_sorted',
+                 'is_opening_balance', '_transactions_ids')
+
+    FIELDS = (('name', 'name'), ('id', 'id'), ('type', 'type'),
+              ('parent', 'parent_id'), ('description', 'description'),
+              ('code', 'code'), ('commodity', 'commodity'),
+              ('commodity-scu', 'commodity_scu'))
+
     def __init__(self, fields):
         GcObj.__init__(self, fields)
         self._path = None
         self._shortpath = None
         self._shortname = None
         self._days = None
+        # the days in order, and their ordinals (see day_ordinal)
+        self._day_list = None
+        self._day_ordinals = None
+        # see _create_timeline
+        self._timeline = None
+        # see Book.use_scaled_ints
+        self._scale = None
+        # see deep_trs_by_date
+        self._deep_trs = None
+        # see fingerprint.subtree_fingerprint
+        self._subtree_fingerprint = None
         # the following are set by the Book
         self._parent = None
         self._children = {}
         self._transactions = []
+        self._splits = []
+        self._splits_sorted = True
         self.is_opening_balance = False
-        self._opening_balance = None
-        self._balance = None
         self._transactions_ids = set()
 
     @property
@@ -260,16 +442,12 @@ class Account(GcObj):
     def __str__(self):
         return "<ac%s>" % self.nice_id
 
-    @property
-    def parent_id(self):
-        return self.fields['parent']
-
     def get_parent(self):
         return self._parent
 
     def set_parent(self, value):
         self._parent = value
-        self.fields['parent'] = value.id
+        self.parent_id = value.id
     parent = property(get_parent, set_parent)
 
     @property
@@ -294,10 +472,6 @@ class Account(GcObj):
             return ""
         return ":".join((self.parent.shortpath, self.shortname))
 
-    @property
-    def name(self):
-        return self.fields['name']
-
     @property
     def shortname(self):
         if self._shortname is None:
@@ -320,36 +494,29 @@ class Account(GcObj):
                     todo[acsn] = []
                 todo[acsn].append(ac)
 
-    @property
-    def type(self):
-        return self.fields['type']
-
-    @property
-    def description(self):
-        return self.fields['description']
-
-    @property
-    def code(self):
-        return self.fields['code']
-
-    @property
-    def commodity(self):
-        return self.fields['commodity']
-
-    @property
-    def commodity_scu(self):
-        return self.fields['commodity-scu']
-
     @property
     def children(self):
         return self._children
 
     @property
     def mutations(self):
-        for tr in self._transactions:
-            for split in tr.splits.values():
-                if split.account == self:
-                    yield split
+        return iter(self.splits)
+
+    # the splits of this account, sorted by the date their
+    # transactions were posted
+    @property
+    def splits(self):
+        if not self._splits_sorted:
+            self._splits.sort(key=_posted)
+            self._splits_sorted = True
+        return self._splits
+
+    def _add_split(self, sp):
+        splits = self._splits
+        if self._splits_sorted and splits and \
+                _posted(sp) < _posted(splits[-1]):
+            self._splits_sorted = False
+        splits.append(sp)
 
     @property
     def transactions(self):
@@ -364,7 +531,7 @@ class Account(GcObj):
 
     def get_deep_mutations(self):
         for desc in self.get_descendants():
-            for mut in desc.mutations:
+            for mut in desc.splits:
                 yield mut
 
     def get_deep_trs(self):
@@ -373,6 +540,20 @@ class Account(GcObj):
             trs.add(mut.transaction)
         return trs
 
+    # the transactions of this account and its descendants, sorted by
+    # the moment they were posted;  merged from those of the children
+    @property
+    def deep_trs_by_date(self):
+        if self._deep_trs is None:
+            own = []
+            for sp in self.splits:
+                if not own or own[-1] is not sp.transaction:
+                    own.append(sp.transaction)
+            self._deep_trs = TransactionsByDate(merge_trs_by_date(
+                [own] + [child.deep_trs_by_date.transactions
+                         for child in six.itervalues(self.children)]))
+        return self._deep_trs
+
     @property
     def nice_id(self):
         return self.path
@@ -390,18 +571,31 @@ class Account(GcObj):
     def _create_days(self):
         days = dict()
         days[""] = AccountDay("", self)
-        for tr in self.transactions:
+        for split in self.splits:
+            tr = split.transaction
             day = tr.day
-            if day not in days:
-                days[day] = AccountDay(day, self)
-            days[day].transactions.append(tr)
-            for split in six.itervalues(tr.splits):
-                if split.account == self:
-                    days[day].value += split.value
+            acday = days.get(day)
+            if acday is None:
+                acday = days[day] = AccountDay(day, self)
+            # the splits of a transaction are next to each other
+            if not acday.transactions or acday.transactions[-1] is not tr:
+                acday.transactions.append(tr)
+            if self._scale is None:
+                acday.value += split.value
+            elif acday.units is None:
+                acday.units = split.units
+            else:
+                acday.units += split.units
+
+        if self._scale is not None:
+            for acday in six.itervalues(days):
+                acday.value = from_units(acday.units, self._scale)
 
         self._days = days
 
         keys = sorted(six.iterkeys(days))
+        self._day_list = [days[key] for key in keys]
+        self._day_ordinals = [day_ordinal(key) for key in keys]
         previous = None
         for key in keys:
             days[key].previous_day = previous
@@ -412,6 +606,23 @@ class Account(GcObj):
                 days[key].starting_balance = Decimal(0)
             previous = days[key]
 
+    # sets the balances of all days at once (see AccountDay.balances)
+    def _create_balances(self):
+        days = self.days
+        splits_by_tr = dict()
+        for split in self.splits:
+            splits_by_tr.setdefault(split.transaction, []).append(split)
+        for acday in six.itervalues(days):
+            total = acday.starting_balance
+            balances = set([total, acday.ending_balance])
+            trs = list(acday.transactions)
+            trs.sort(key=lambda tr: tr.num)
+            for tr in trs:
+                for split in splits_by_tr[tr]:
+                    total += split.value
+                    balances.add(total)
+            acday._balances = balances
+
     @property
     def mutation_sign(self):
         if self.type not in ACCOUNT_SIGNS:
@@ -424,43 +635,162 @@ class Account(GcObj):
             raise KeyError('unknown account type %r' % (self.type,))
         return ACCOUNT_SIGNS[self.type]['balance']
 
+    # The balance of the account and its descendants at the end of day;
+    # day=None gives the current balance, day="" the opening balance.
     def get_balance_on(self, day):
-        total = Decimal(0)
-        for child in six.itervalues(self.children):
-            total += child.get_balance_on(day)
-        return total + self.get_last_acday_before(day).ending_balance
-
+        return self.get_balance_on_ordinal(
+            None if day is None else day_ordinal(day))
+
+    def get_balance_on_ordinal(self, ordinal):
+        if self._timeline is None:
+            self._create_timeline()
+        ordinals, deltas, balances = self._timeline
+        if ordinal is None:
+            balance = balances[-1]
+        else:
+            balance = balances[bisect_right(ordinals, ordinal) - 1]
+        if self._scale is None:
+            return balance
+        return from_units(balance, self._scale)
+
+    # The timeline of the account and its descendants consists of the
+    # ordinals of the days on which any of them has transactions, the
+    # total value of those transactions per day, and the balance of the
+    # subtree at the end of each day.  It is merged from the days of the
+    # account and the timelines of its children.  In scaled-integer mode
+    # the values and balances are ints, or None when there are none yet.
+    def _create_timeline(self):
+        if not self._days:
+            self._create_days()
+        if self._scale is None:
+            values = [acday.value for acday in self._day_list]
+        else:
+            values = [acday.units for acday in self._day_list]
+        # (the index keeps heapq.merge from comparing the values)
+        series = [zip(self._day_ordinals, repeat(0), values)]
+        for i, child in enumerate(six.itervalues(self.children)):
+            if child._timeline is None:
+                child._create_timeline()
+            series.append(zip(child._timeline[0], repeat(i + 1),
+                              child._timeline[1]))
+        ordinals = []
+        deltas = []
+        for ordinal, _, value in heapq.merge(*series):
+            if not ordinals or ordinals[-1] != ordinal:
+                ordinals.append(ordinal)
+                deltas.append(value)
+            elif deltas[-1] is None:
+                deltas[-1] = value
+            elif value is not None:
+                deltas[-1] += value
+        balances = []
+        total = Decimal(0) if self._scale is None else None
+        for delta in deltas:
+            if total is None:
+                total = delta
+            elif delta is not None:
+                total += delta
+            balances.append(total)
+        self._timeline = (ordinals, deltas, balances)
+
+    # Returns the last account-day on or before day (see get_balance_on).
     def get_last_acday_before(self, day):
-        acday = self.opening_day
-        while True:
-            nextad = acday.next_day
-            if nextad == None or nextad.is_after(day):
-                return acday
-            acday = nextad
+        return self.get_last_acday_before_ordinal(
+            None if day is None else day_ordinal(day))
+
+    def get_last_acday_before_ordinal(self, ordinal):
+        if not self._days:
+            self._create_days()
+        if ordinal is None:
+            return self._day_list[-1]
+        return self._day_list[bisect_right(self._day_ordinals, ordinal) - 1]
 
     @property
     def opening_balance(self):
-        if self._opening_balance==None:
-            self._opening_balance = self.get_balance_on("")
-        return self._opening_balance
+        return self.get_balance_on_ordinal(0)
 
     @property
     def balance(self):
-        if self._balance==None:
-            self._balance = self.get_balance_on(None)
-        return self._balance
+        return self.get_balance_on_ordinal(None)
+
+# Turns an int number of units of 10**scale into a Decimal with exponent
+# scale, like the sum of the Decimal values would have been;  None,
+# the empty sum, is Decimal(0).
+def from_units(units, scale):
+    if units is None:
+        return Decimal(0)
+    return Decimal(units).scaleb(scale)
+
+
+def _posted(split):
+    return split.transaction.date_posted.timestamp
+
+
+def _tr_posted(tr):
+    return tr.date_posted.timestamp
+
+
+# Merges lists of transactions sorted by the moment they were posted
+# into one such list, without duplicates.
+def merge_trs_by_date(lists):
+    if len(lists) == 1:
+        return list(lists[0])
+    # (the indices keep heapq.merge from comparing transactions)
+    merged = heapq.merge(*[[(_tr_posted(tr), i, j, tr)
+                            for j, tr in enumerate(trs)]
+                           for i, trs in enumerate(lists)])
+    result = []
+    seen = set()
+    for _, _, _, tr in merged:
+        if tr.id not in seen:
+            seen.add(tr.id)
+            result.append(tr)
+    return result
+
+
+# A list of transactions sorted by the moment they were posted,
+# which can be queried for those posted in a period.
+class TransactionsByDate(object):
+
+    __slots__ = ('timestamps', 'transactions')
+
+    def __init__(self, trs):
+        self.transactions = trs
+        self.timestamps = [_tr_posted(tr) for tr in trs]
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __iter__(self):
+        return iter(self.transactions)
+
+    # the transactions posted from begin up to and including end (both
+    # timestamps, and both optional, like balance.tr_in_period)
+    def between(self, begin=None, end=None):
+        lo = bisect_left(self.timestamps, begin) if begin else 0
+        hi = bisect_right(self.timestamps, end) if end \
+            else len(self.timestamps)
+        return self.transactions[lo:hi]
+
 
 @six.python_2_unicode_compatible
-class AccountDay:
+class AccountDay(object):
+
+    __slots__ = ('day', 'account', 'transactions', 'value', 'units',
+                 'previous_day', 'next_day', 'starting_balance', '_balances',
+                 '_checks')
 
     def __init__(self, day, account):
         self.day = day
         self.account = account
         self.transactions = []
         self.value = Decimal(0)
+        # the value in scaled-integer mode (see Book.use_scaled_ints)
+        self.units = None
         self.previous_day = None
         self.next_day = None
         self.starting_balance = None
+        self._balances = None
         self._checks = None
 
     @property
@@ -477,21 +807,36 @@ class AccountDay:
     def ending_balance(self):
         return self.starting_balance + self.value
 
+    # the balances the account has during the day:  the starting and
+    # ending balance, and the balance after each of its splits, when
+    # the transactions are taken in the order of their numbers
+    @property
+    def balances(self):
+        if self._balances is None:
+            self.account._create_balances()
+        return self._balances
+
     def __str__(self):
         return "<%s of %s>" % (self.day, self.account.path)
 
     def is_after(self, day):
         if day==None:
             return False
-        if day=="":
-            return self.day!=""
-        return datetime.strptime(self.day, "%Y-%m-%d") < \
-                datetime.strptime(day, "%Y-%m-%d")
+        return day_ordinal(self.day) > day_ordinal(day)
 
 
 @six.python_2_unicode_compatible
 class Transaction(GcObj):
 
+    __slots__ = ('id', 'description', 'num', 'splits', 'currency',
+                 'date_posted', 'date_entered',
+                 '_day', 'is_census', 'census')
+
+    FIELDS = (('id', 'id'), ('description', 'description'), ('num', 'num'),
+              ('splits', 'splits'), ('currency', 'currency'),
+              ('date-posted', 'date_posted'),
+              ('date-entered', 'date_entered'))
+
     def __init__(self, fields):
         GcObj.__init__(self, fields)
         self._day = None
@@ -511,31 +856,6 @@ class Transaction(GcObj):
         else:
             return "id" + self.id
 
-
-    @property
-    def splits(self):
-        return self.fields['splits']
-
-    @property
-    def description(self):
-        return self.fields['description']
-
-    @property
-    def num(self):
-        return self.fields['num']
-
-    @property
-    def date_posted(self):
-        return self.fields['date-posted']
-
-    @property
-    def date_entered(self):
-        return self.fields['date-entered']
-
-    @property
-    def currency(self):
-        return self.fields['currency']
-
     @property
     def day(self):
         if self._day is None:
@@ -553,9 +873,17 @@ class Transaction(GcObj):
 @six.python_2_unicode_compatible
 class Split(GcObj):
 
+    __slots__ = ('id', 'value', 'quantity', 'account_id', 'memo',
+                 'reconciled_state', 'units', '_account', '_transaction')
+
+    FIELDS = (('id', 'id'), ('value', 'value'), ('quantity', 'quantity'),
+              ('account', 'account_id'), ('memo', 'memo'),
+              ('reconciled-state', 'reconciled_state'))
+
     def __init__(self, fields):
         GcObj.__init__(self, fields)
         # set by Book
+        self.units = None
         self._account = None
         self._transaction = None
 
@@ -568,52 +896,41 @@ class Split(GcObj):
                                         self.account.nice_id,
                                         self.transaction.num)
 
-    @property
-    def account_id(self):
-        return self.fields['account']
-
     def get_account(self):
         return self._account
 
     def set_account(self, value):
         self._account = value
-        self.fields['account'] = value.id
+        self.account_id = value.id
     account = property(get_account, set_account)
 
     @property
     def transaction(self):
         return self._transaction
 
-    @property
-    def memo(self):
-        return self.fields['memo']
 
-    @property
-    def reconciled_state(self):
-        return self.fields['reconciled-state']
 
-    @property
-    def quantity(self):
-        return self.fields['quantity']
+# Commodities and timestamps are immutable and shared between the
+# objects that refer to the same one (see xmlformat).
 
-    @property
-    def value(self):
-        return self.fields['value']
+class Commodity(GcStruct):
 
+    __slots__ = ('space', 'id', 'quote_source')
 
-class Commodity(GcStruct):
+    FIELDS = (('space', 'space'), ('id', 'id'),
+              ('quote_source', 'quote_source'))
 
     def __init__(self, fields):
         GcStruct.__init__(self, fields)
 
-    @property
-    def id(self):
-        return self.fields['id']
-
 
 @six.python_2_unicode_compatible
 class TimeStamp(GcStruct):
 
+    __slots__ = ('timestamp', 'ns')
+
+    FIELDS = (('date', 'timestamp'), ('ns', 'ns'))
+
     def __init__(self, fields):
         GcStruct.__init__(self, fields)
 
@@ -628,10 +945,3 @@ class TimeStamp(GcStruct):
     def date(self):
         return self.datetime.date()
 
-    @property
-    def timestamp(self):
-        return self.fields['date']
-
-    @property
-    def ns(self):
-        return self.fields['ns']
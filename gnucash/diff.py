@@ -1,5 +1,12 @@
-from .core import GcStruct
+from .core import GcStruct, Book, Transaction, File
+from .fingerprint import fingerprint, changed_subtrees
+import json
 import six
+from collections import OrderedDict, deque, namedtuple
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 # Some general code concerning "difference functions".
 # A *difference function*  diff  assigns to each pair A B of objects
@@ -46,13 +53,20 @@ class InDiff(object):
         self.differ = False
 
 
+@six.python_2_unicode_compatible
+class NoDiff(InDiff):
+
+    def __str__(self):
+        return "(no difference)"
+
+
 def _dictDiffit(A, B, diff):
     for k in A.keys():
         a = A[k]
         if k in B:
             b = B[k]
             d = diff(a, b)
-            if diff(a, b).differ:
+            if d.differ:
                 yield (k, a, b, d)
         else:
             yield (k, a, None, None)
@@ -129,44 +143,349 @@ def DeepDiff(succDiff, zeroDiff, isSucc):
 
 def DeepDictDiff(diff):
     return DeepDiff(DictDiff, diff,
-                    lambda a, b: isinstance(a, dict) and isinstance(b, dict))
-
-
-class _LutedDiffCtx(object):
-
-    def __init__(self, origDiff):
-        self.origDiff = origDiff
-        self.lut = dict()
-
-    def diff(self, a, b):
-        d = None
-        if (a, b) not in self.lut:
-            d = self.origDiff(a, b)
-            self.lut[(a, b)] = d
-        else:
-            d = self.lut[(a, b)]
+                    lambda a, b: isinstance(a, Mapping) and
+                    isinstance(b, Mapping))
+
+
+class DiffMemo(object):
+    """Remembers diff(a, b) for the pairs a b of objects met during one
+    diff, by their identity.
+
+    At most max_size pairs are remembered;  the least recently used
+    pair is forgotten first.  The pairs are kept alive while they are
+    remembered, so that their ids can not be reused by other objects."""
+
+    def __init__(self, max_size=1 << 16):
+        self.max_size = max_size
+        self.lut = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.lut)
+
+    def lookup(self, diff, a, b):
+        key = (id(a), id(b))
+        entry = self.lut.pop(key, None)
+        if entry is not None and entry[0] is a and entry[1] is b:
+            self.hits += 1
+            self.lut[key] = entry
+            return entry[2]
+        self.misses += 1
+        d = diff(a, b)
+        self.lut[key] = (a, b, d)
+        if len(self.lut) > self.max_size:
+            self.lut.popitem(last=False)
+            self.evictions += 1
         return d
 
 
-def LutedDiff(diff):
-    return _LutedDiffCtx(diff).diff
+def LutedDiff(diff, memo=None):
+    if memo is None:
+        memo = DiffMemo()
+    return lambda a, b: memo.lookup(diff, a, b)
 
 ###############################################################################
 
 
-def ShallowGcStructDiff(diff):
-    return LutedDiff(lambda a, b: DeepDictDiff(diff)(a.fields, b.fields))
+def ShallowGcStructDiff(diff, memo=None, match=False):
+    return LutedDiff(FingerprintedDiff(
+        lambda a, b: DeepDictDiff(diff)(*_diff_fields(a, b, match))), memo)
+
+
+# The GcStructs a and b are only compared field by field when their
+# fingerprints (see gnucash.fingerprint) differ.
+def FingerprintedDiff(diff):
+    def fpdiff(a, b):
+        if fingerprint(a) == fingerprint(b):
+            return NoDiff(a, b)
+        return diff(a, b)
+    return fpdiff
+
+
+# The fields of a and b to compare;  of two books only the accounts in
+# subtrees that changed are compared (see _changed_account_ids), and the
+# accounts are skipped altogether when there are none.  When match is
+# set, the re-entered transactions of b, and the new splits of a
+# transaction, are put under the key of their match in a (see
+# iter_changes), so that they are compared with it.
+def _diff_fields(a, b, match=False):
+    fa, fb = a.fields, b.fields
+    if match and isinstance(a, Transaction) and isinstance(b, Transaction):
+        fb = dict(fb)
+        fb['splits'] = _rekeyed(a.splits, b.splits,
+                                (_sp_signature, _sp_account))
+    if isinstance(a, Book) and isinstance(b, Book):
+        ids = _changed_account_ids(a, b)
+        fa = dict((k, v) for k, v in six.iteritems(fa) if k != 'accounts')
+        fb = dict((k, v) for k, v in six.iteritems(fb) if k != 'accounts')
+        if ids:
+            # (in the order of the books)
+            fa['accounts'] = dict((key, ac) for key, ac
+                                  in six.iteritems(a.accounts) if key in ids)
+            fb['accounts'] = dict((key, ac) for key, ac
+                                  in six.iteritems(b.accounts) if key in ids)
+        if match:
+            fb['transactions'] = _rekeyed(a.transactions, b.transactions,
+                                          (_tr_signature,))
+    return fa, fb
+
+
+# The objects of B, where those not in A that are paired (see _match)
+# with an object of A not in B are under the key of the latter instead.
+def _rekeyed(A, B, signatures):
+    removed = [obj for key, obj in six.iteritems(A) if key not in B]
+    added = [obj for key, obj in six.iteritems(B) if key not in A]
+    pairs = [(obj_a, obj_b) for obj_a, obj_b
+             in _match(removed, added, signatures)
+             if obj_a is not None and obj_b is not None]
+    if not pairs:
+        return B
+    B = dict(B)
+    for obj_a, obj_b in pairs:
+        del B[obj_b.id]
+        B[obj_a.id] = obj_b
+    return B
+
+
+# The ids of the accounts of the books a and b that may differ:  those
+# in the subtrees whose fingerprints differ (see changed_subtrees).  Of
+# a subtree found in only one of the books all accounts are included,
+# as they may have moved elsewhere in the other book.
+def _changed_account_ids(a, b):
+    ids = set()
+    for ac_a, ac_b in changed_subtrees(a, b):
+        if ac_a is not None and ac_b is not None:
+            ids.add(ac_a.id)
+            continue
+        for desc in (ac_a or ac_b).get_descendants():
+            ids.add(desc.id)
+    return ids
+
+
+# Computes the difference of the GcStructs a and b.  The differences of
+# the pairs of objects met on the way are remembered in memo (by default
+# a new DiffMemo) for the duration of the call only.  Unless match is
+# unset, re-entered transactions are paired as by iter_changes.
+def GcStructDiff(a, b, memo=None, match=True):
+    if memo is None:
+        memo = DiffMemo()
+    return DeepDiff(
+        lambda diff: ShallowGcStructDiff(diff, memo, match),
+        EqDiff,
+        lambda a,
+        b: isinstance(
+            a,
+            GcStruct) and isinstance(
+                b,
+            GcStruct))(a, b)
 
+###############################################################################
+# Streaming diff:  iter_changes yields the differences between two files
+# (or books) one Change at a time, as soon as it is found, instead of
+# building one DiffitObj for the whole file.
+#
+#   action  "added", "removed" or "changed"
+#   kind    "book", "account", "transaction", "split" or "commodity"
+#   id      the GUID (or, for a commodity, the id) of the object
+#   field   the name of the changed field (None when added or removed)
+#   old     the old value of the field, or the removed object
+#   new     the new value of the field, or the added object
+#
+# Objects are paired by GUID.  When match is set, a transaction that was
+# removed is moreover paired with an added transaction with the same
+# date, num, amounts and accounts (see _tr_signature), as happens when
+# a transaction is deleted and entered again, or imported twice;  such
+# pairs are reported as changed, in the field "id" among others, and
+# only after all transactions paired by GUID.  Within a transaction,
+# new splits are paired in the same way with removed splits with the
+# same account (and preferably the same amounts).
+
+Change = namedtuple("Change", ("action", "kind", "id", "field", "old", "new"))
+
+
+def iter_changes(A, B, match=True):
+    if isinstance(A, File):
+        books = _pairs(A.books, B.books)
+    else:
+        books = [(A.id, A, B)]
+    for key, a, b in books:
+        if a is None or b is None:
+            yield _added_or_removed("book", key, a, b)
+            continue
+        if fingerprint(a) == fingerprint(b):
+            continue
+        for change in _iter_book_changes(a, b, match):
+            yield change
+
+
+def _iter_book_changes(a, b, match):
+    for key, ca, cb in _pairs(a.commodities, b.commodities):
+        for change in _object_changes("commodity", key, ca, cb):
+            yield change
+    ids = _changed_account_ids(a, b)
+    if ids:
+        for key, aca, acb in _pairs(a.accounts, b.accounts):
+            if key not in ids:
+                continue
+            for change in _object_changes("account", key, aca, acb):
+                yield change
+    removed = []
+    added = []
+    for key, tra, trb in _pairs(a.transactions, b.transactions):
+        if match and tra is None:
+            added.append(trb)
+        elif match and trb is None:
+            removed.append(tra)
+        else:
+            for change in _object_changes("transaction", key, tra, trb,
+                                          match):
+                yield change
+    for tra, trb in _match(removed, added, (_tr_signature,)):
+        key = (tra or trb).id
+        for change in _object_changes("transaction", key, tra, trb, match):
+            yield change
+
+
+def _object_changes(kind, key, a, b, match=False):
+    if a is None or b is None:
+        yield _added_or_removed(kind, key, a, b)
+        return
+    if fingerprint(a) == fingerprint(b):
+        return
+    fa, fb = a.fields, b.fields
+    for field in fa:
+        if field == "splits":
+            continue
+        va, vb = fa[field], fb.get(field)
+        if not _same(va, vb):
+            yield Change("changed", kind, key, field, va, vb)
+    for field in fb:
+        if field not in fa:
+            yield Change("changed", kind, key, field, None, fb[field])
+    if kind == "transaction":
+        removed = []
+        added = []
+        for sp_key, spa, spb in _pairs(a.splits, b.splits):
+            if match and spa is None:
+                added.append(spb)
+            elif match and spb is None:
+                removed.append(spa)
+            else:
+                for change in _object_changes("split", sp_key, spa, spb):
+                    yield change
+        for spa, spb in _match(removed, added,
+                               (_sp_signature, _sp_account)):
+            for change in _object_changes("split", (spa or spb).id,
+                                          spa, spb):
+                yield change
+
+
+# Pairs the objects of removed with those of added for which the first
+# of the signatures agrees, then those left over for which the second
+# agrees, and so on, each time through a dict indexed by the signature,
+# so that not all pairs need be compared.  Returns the pairs, followed
+# by the objects that are left over, each paired with None.
+def _match(removed, added, signatures):
+    for signature in signatures:
+        if not removed or not added:
+            break
+        index = dict()
+        for obj in removed:
+            index.setdefault(signature(obj), deque()).append(obj)
+        pairs = []
+        unmatched = []
+        for obj in added:
+            candidates = index.get(signature(obj))
+            if candidates:
+                pairs.append((candidates.popleft(), obj))
+            else:
+                unmatched.append(obj)
+        matched = set(id(obj) for obj, _ in pairs)
+        removed = [obj for obj in removed if id(obj) not in matched]
+        added = unmatched
+        for pair in pairs:
+            yield pair
+    for obj in removed:
+        yield obj, None
+    for obj in added:
+        yield None, obj
+
+
+def _tr_signature(tr):
+    splits = list(six.itervalues(tr.splits))
+    return (tr.date_posted.date, tr.num,
+            tuple(sorted(sp.value for sp in splits)),
+            tuple(sorted(sp.account_id for sp in splits)))
+
+
+def _sp_signature(sp):
+    return (sp.account_id, sp.value, sp.quantity)
+
+
+def _sp_account(sp):
+    return sp.account_id
+
+
+def _added_or_removed(kind, key, a, b):
+    if a is None:
+        return Change("added", kind, key, None, None, b)
+    return Change("removed", kind, key, None, a, None)
+
+
+# Yields (key, A[key], B[key]) for the keys of A and then the new keys
+# of B, with None for missing entries.
+def _pairs(A, B):
+    for key in A:
+        yield key, A[key], B.get(key)
+    for key in B:
+        if key not in A:
+            yield key, None, B[key]
+
+
+def _same(a, b):
+    if isinstance(a, GcStruct) and isinstance(b, GcStruct):
+        return fingerprint(a) == fingerprint(b)
+    return a == b
+
+
+# Turns the values of a Change into something json can handle.
+def jsonable(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, GcStruct):
+        return jsonable(value.fields)
+    if isinstance(value, Mapping):
+        return dict((six.text_type(k), jsonable(v))
+                    for k, v in six.iteritems(value))
+    if isinstance(value, (list, tuple)):
+        return [jsonable(v) for v in value]
+    return six.text_type(value)
+
+
+def emit_jsonl(changes, out):
+    for change in changes:
+        out.write(json.dumps(dict((name, jsonable(value)) for name, value
+                                  in zip(Change._fields, change)),
+                             sort_keys=True))
+        out.write("\n")
+
+
+def format_change(change):
+    if change.action == "added":
+        return "+%s %s (%s)" % (change.kind, change.id, change.new)
+    if change.action == "removed":
+        return "-%s %s (%s)" % (change.kind, change.id, change.old)
+    return "~%s %s %s: %s -> %s" % (change.kind, change.id, change.field,
+                                    change.old, change.new)
+
+
+def emit_text(changes, out):
+    for change in changes:
+        out.write(format_change(change))
+        out.write("\n")
 
-GcStructDiff = DeepDiff(
-    ShallowGcStructDiff,
-    EqDiff,
-    lambda a,
-    b: isinstance(
-        a,
-        GcStruct) and isinstance(
-            b,
-        GcStruct))
 
 if __name__ == "__main__":
     print(" *** Testing koert.gnucash.diff ***")
@@ -8,10 +8,10 @@ from koert.gnucash import core as gnucash
 
 
 def get_user_balance(book, accounts):
-    trs = set([])
     accounts = set(accounts)
     accounts_to_remove = set()
     accounts_to_add = set()
+    trs_by_date = []
 
     # add the children and remove the non-existent accounts
     for account in accounts:
@@ -22,17 +22,11 @@ def get_user_balance(book, accounts):
             continue
         for d in ac.get_descendants():
             accounts_to_add.add(d.path)
+        trs_by_date.append(ac.deep_trs_by_date.transactions)
     accounts -= accounts_to_remove
     accounts |= accounts_to_add
 
-    for account in accounts:
-        ac = book.ac_by_path(account)
-        for mut in ac.mutations:
-            trs.add(mut.transaction)
-
-    trs = list(trs)
-
-    trs.sort(key=lambda a: a.date_posted.timestamp)
+    trs = gnucash.merge_trs_by_date(trs_by_date)
 
     sumptr = [0]
     trs = [tr_data(tr, accounts, sumptr) for tr in trs]
@@ -87,6 +81,8 @@ def get_debitors(book, accounts, day=None, onlypositive=True):
 
     for path in accounts:
         todo.append(book.ac_by_path(path))
+
+    ordinal = None if day is None else gnucash.day_ordinal(day)
     
     while len(todo)>0:
         ac = todo.pop()
@@ -99,7 +95,7 @@ def get_debitors(book, accounts, day=None, onlypositive=True):
 
             if name not in result:
                 result[name] = 0
-            acday = child.get_last_acday_before(day)
+            acday = child.get_last_acday_before_ordinal(ordinal)
             result[name] += acday.ending_balance
 
     result = [(name, result[name]) for name in result]
@@ -0,0 +1,97 @@
+"""Merkle-style fingerprints of the objects of a parsed gnucash file.
+
+The fingerprint of a GcStruct is the SHA1 digest of its type and its
+fields, where GcStructs among the fields (also inside dicts and lists)
+enter only through their own fingerprints.  Hence the fingerprint of a
+transaction covers its splits, that of a book all its accounts and
+transactions, and objects with the same fingerprint have the same
+fields, so that a diff (see gnucash.diff) need not look inside them.
+
+The fingerprints of books, accounts, transactions and splits are
+computed only once (and are kept in snapshots, see gnucash.snapshot);
+these objects are not supposed to change after they have been parsed.
+
+The subtree fingerprint of an account covers the account and all its
+descendants.
+"""
+
+from .core import GcStruct, GcObj
+import hashlib
+import six
+import struct
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+_LENGTH = struct.Struct("<I")
+
+
+def fingerprint(obj):
+    fp = obj._fingerprint if isinstance(obj, GcObj) else None
+    if fp is None:
+        h = hashlib.sha1(type(obj).__name__.encode("utf-8"))
+        if obj.FIELDS is None:
+            h.update(_encode(obj.fields))
+        else:
+            # (the fields of the type are always the same, in this order)
+            for name, attr in obj.FIELDS:
+                h.update(_encode(getattr(obj, attr)))
+        fp = h.digest()
+        if isinstance(obj, GcObj):
+            obj._fingerprint = fp
+    return fp
+
+
+def subtree_fingerprint(ac):
+    if ac._subtree_fingerprint is None:
+        h = hashlib.sha1(fingerprint(ac))
+        for fp in sorted(subtree_fingerprint(child)
+                         for child in six.itervalues(ac.children)):
+            h.update(fp)
+        ac._subtree_fingerprint = h.digest()
+    return ac._subtree_fingerprint
+
+
+# Yields the pairs of accounts with the same id in the books a and b
+# whose subtree fingerprints differ, skipping the subtrees that agree;
+# accounts that appear in only one of the books are paired with None.
+def changed_subtrees(a, b):
+    todo = [(a.root, b.root)]
+    while todo:
+        ac_a, ac_b = todo.pop()
+        if ac_a is None or ac_b is None:
+            yield ac_a, ac_b
+            continue
+        if subtree_fingerprint(ac_a) == subtree_fingerprint(ac_b):
+            continue
+        yield ac_a, ac_b
+        children_b = dict((child.id, child)
+                          for child in six.itervalues(ac_b.children))
+        for child in six.itervalues(ac_a.children):
+            todo.append((child, children_b.pop(child.id, None)))
+        for child in six.itervalues(children_b):
+            todo.append((None, child))
+
+
+def _encode(value):
+    if value is None:
+        return b"N"
+    if isinstance(value, GcStruct):
+        return b"G" + fingerprint(value)
+    if isinstance(value, Mapping):
+        h = hashlib.sha1()
+        for key in sorted(value, key=six.text_type):
+            h.update(_encode(key))
+            h.update(_encode(value[key]))
+        return b"M" + h.digest()
+    if isinstance(value, (list, tuple)):
+        h = hashlib.sha1()
+        for item in value:
+            h.update(_encode(item))
+        return b"L" + h.digest()
+    if isinstance(value, six.text_type):
+        data = value.encode("utf-8")
+        return b"S" + _LENGTH.pack(len(data)) + data
+    data = (type(value).__name__ + ":" + repr(value)).encode("utf-8")
+    return b"R" + _LENGTH.pack(len(data)) + data
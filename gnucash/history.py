@@ -0,0 +1,125 @@
+"""The history of a gnucash file kept in a git repository.
+
+history(repopath, filepath, rev) yields, for each commit in rev that
+changed the gnucash file at filepath, the changes it made to the file
+(see gnucash.diff.iter_changes).  Commits in which the blob of the file
+is the same as in the commit before are skipped, and each distinct blob
+is parsed only once, by a pool of processes, which store their results
+in a BookCache (see gnucash.tools), from which they are loaded in turn.
+Blobs that are already in the cache are not parsed at all.
+"""
+
+from .diff import iter_changes
+from .tools import BookCache, parse_gcf, expatparse
+from collections import namedtuple
+from git import Repo
+import binascii
+import io
+import os
+import shutil
+import tempfile
+
+#   commit   the git commit
+#   blob     the git blob SHA of the gnucash file in this commit
+#   mtime    the time the commit was authored
+#   gcf      the parsed gnucash file (see gnucash.core.File)
+#   changes  the changes since the previous version (see gnucash.diff)
+Revision = namedtuple("Revision",
+                      ("commit", "blob", "mtime", "gcf", "changes"))
+
+
+# Returns the version of filepath before rev (a commit, or a range as
+# accepted by git log, such as 'a..b'), as a git blob SHA, or None if
+# there is none, and the commits in rev that changed filepath, in the
+# order of git log, but oldest first, each with the blob SHA of filepath
+# and the time it was authored.
+def file_versions(repo, filepath, rev="HEAD"):
+    before = None
+    versions = []
+    for commit in repo.iter_commits(rev, paths=filepath, reverse=True):
+        if not versions and commit.parents:
+            before = _blob_sha(commit.parents[0], filepath)
+        sha = _blob_sha(commit, filepath)
+        if sha is None:
+            continue
+        # (git log also lists merges, and commits that undo themselves)
+        if sha == (versions[-1][1] if versions else before):
+            continue
+        versions.append((commit, sha, commit.authored_date))
+    return before, versions
+
+
+def _blob_sha(commit, filepath):
+    try:
+        return commit.tree[filepath].hexsha
+    except KeyError:
+        return None
+
+
+# Yields a Revision for each commit in rev that changed the gnucash file
+# at filepath (see file_versions).  The changes of the first are None
+# when there is no version of the file before rev.
+#
+# The parsed files are kept in cache (a BookCache), or, if it is not
+# given, in a temporary directory that is removed afterwards.  The
+# parsing is done by workers processes (by default one per cpu).
+def history(repopath, filepath, rev="HEAD", cache=None, workers=None):
+    from concurrent.futures import ProcessPoolExecutor
+    repo = Repo(repopath)
+    before, versions = file_versions(repo, filepath, rev)
+    tmpdir = None
+    if cache is None:
+        tmpdir = tempfile.mkdtemp(prefix="koert-history-")
+        cache = BookCache(tmpdir, max_size=float("inf"), max_in_memory=0)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    shas = ([before] if before is not None else []) \
+        + [sha for commit, sha, mtime in versions]
+    todo = []
+    for sha in shas:
+        if sha not in todo and not os.path.exists(cache.path(sha)):
+            todo.append(sha)
+    executor = ProcessPoolExecutor(max_workers=workers)
+    parsing = dict((sha, executor.submit(
+        _parse_blob, repo.git_dir, sha, cache.directory)) for sha in todo)
+    try:
+        previous = None
+        if before is not None:
+            previous = _load(cache, parsing, before)
+        for commit, sha, mtime in versions:
+            gcf = _load(cache, parsing, sha)
+            changes = None
+            if previous is not None:
+                changes = list(iter_changes(previous, gcf))
+            yield Revision(commit, sha, mtime, gcf, changes)
+            previous = gcf
+    finally:
+        # (when the caller stopped early, the remaining blobs are skipped)
+        for future in parsing.values():
+            future.cancel()
+        executor.shutdown()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        else:
+            # (the workers do not evict, lest they remove each other's)
+            cache.evict()
+
+
+def _load(cache, parsing, sha):
+    if sha in parsing:
+        # raises the exception of the worker, if any
+        parsing.pop(sha).result()
+    gcf = cache.load(sha)
+    if gcf is None:
+        raise RuntimeError("failed to load blob %s from the cache" % (sha,))
+    return gcf
+
+
+# Parses the blob with the given SHA, and stores the result in the
+# BookCache in directory.  This is run in the workers of history.
+def _parse_blob(repopath, sha, directory):
+    repo = Repo(repopath)
+    data = repo.odb.stream(binascii.unhexlify(sha)).read()
+    parse_gcf(io.BytesIO(data), None, parse=expatparse, key=sha,
+              cache=BookCache(directory, max_size=float("inf"),
+                              max_in_memory=0))
@@ -0,0 +1,323 @@
+from koert.gnucash.tools import open_yaml
+from koert.gnucash import export
+import six
+import json
+import os.path
+import threading
+import time
+import traceback
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn, UnixStreamServer
+from six.moves.urllib.parse import urlparse, parse_qs
+
+# Keeps the books of a number of yaml files (see tools.open_yaml) in
+# memory, and answers queries about them over HTTP, either on localhost
+# or on a unix socket:
+#
+#   GET /                                   the names of the books
+#   GET /<book>/export?handle=H             export of obj_by_handle(H)
+#   GET /<book>/handles?handle=H            handles of obj_by_handle(H)
+#   GET /<book>/balance?account=A&...       get_user_balance
+#   GET /<book>/debitors?account=A&...[&day=D][&alsonegative=1]
+#                                           get_debitors
+#   GET /<book>/checks                      export_checks_of_book
+#
+# The name of a book is the name of its yaml file without extension.
+# A background thread polls the yaml files and the gnucash files (or
+# repositories) they point to; a changed book is reparsed, prepared
+# and then swapped in, while the old book keeps answering queries.
+
+
+class BookServer(object):
+
+    def __init__(self, yaml_paths, interval=10, cache=None):
+        self.paths = dict()
+        for path in yaml_paths:
+            name = os.path.splitext(os.path.basename(path))[0]
+            if name in self.paths:
+                raise ValueError("two books named %s" % (name,))
+            self.paths[name] = path
+        self.interval = interval
+        self.cache = cache
+        self.books = dict()
+        self._loaded_at = dict()
+        self._stop = threading.Event()
+        self._watcher = None
+
+    def load(self, name):
+        """(Re)loads the book name if its files changed since the last
+        load; returns whether it did."""
+        started = time.time()
+        gcf = open_yaml(self.paths[name], onlyafter=self._loaded_at.get(name),
+                        cache=self.cache, previous=self.books.get(name))
+        if gcf is None:
+            return False
+        _prepare(gcf.book)
+        self.books[name] = gcf.book
+        self._loaded_at[name] = started
+        return True
+
+    def refresh(self):
+        for name in self.paths:
+            try:
+                if self.load(name):
+                    print("loaded %s" % (name,))
+            except Exception:
+                print("failed to load %s:" % (name,))
+                traceback.print_exc()
+
+    def start_watching(self):
+        def watch():
+            while not self._stop.wait(self.interval):
+                self.refresh()
+        self._watcher = threading.Thread(target=watch, name="koert-watcher")
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def stop_watching(self):
+        self._stop.set()
+
+    def query(self, name, command, params):
+        return COMMANDS[command](self.books[name], params)
+
+
+# Computes the lazily built parts of the book up front, so that
+# concurrent queries do not build them at the same time.
+def _prepare(book):
+    book.trs_by_num
+    book.obj_by_id
+    for ac in six.itervalues(book.accounts):
+        ac.days
+        ac.opening_balance
+        ac.balance
+
+
+def _param(params, name, default=None):
+    values = params.get(name)
+    if not values:
+        if default is None:
+            raise ValueError("missing parameter %s" % (name,))
+        return default
+    return values[0]
+
+
+def _query_export(book, params):
+    return [export.export(obj)
+            for obj in book.obj_by_handle(_param(params, "handle"))]
+
+
+def _query_handles(book, params):
+    return [obj.handle for obj in book.obj_by_handle(_param(params, "handle"))]
+
+
+def _query_balance(book, params):
+    return export.get_user_balance(book, params.get("account", []))
+
+
+def _query_debitors(book, params):
+    return export.get_debitors(
+        book, params.get("account", []),
+        day=params.get("day", [None])[0],
+        onlypositive=not params.get("alsonegative"))
+
+
+def _query_checks(book, params):
+    return export.export_checks_of_book(book)
+
+
+COMMANDS = {
+    "export": _query_export,
+    "handles": _query_handles,
+    "balance": _query_balance,
+    "debitors": _query_debitors,
+    "checks": _query_checks,
+}
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        parts = [part for part in url.path.split("/") if part]
+        server = self.server.book_server
+        try:
+            if not parts:
+                self._reply(200, sorted(server.books))
+                return
+            if len(parts) != 2:
+                self._reply(404, "no such query")
+                return
+            name, command = parts
+            if name not in server.books or command not in COMMANDS:
+                self._reply(404, "no such book or query")
+                return
+            self._reply(200, server.query(name, command, params))
+        except ValueError as e:
+            self._reply(400, six.text_type(e))
+        except Exception as e:
+            traceback.print_exc()
+            self._reply(500, repr(e))
+
+    def _reply(self, status, data):
+        body = json.dumps(data, default=six.text_type).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _TCPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = UnixStreamServer.get_request(self)
+        # BaseHTTPRequestHandler expects an (address, port) pair
+        return request, ("unix", 0)
+
+
+def serve(book_server, port=None, socket_path=None):
+    """Serves the queries of book_server on localhost:port or,
+    if socket_path is given, on the unix socket socket_path."""
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = _UnixServer(socket_path, _RequestHandler)
+    else:
+        httpd = _TCPServer(("127.0.0.1", port), _RequestHandler)
+    httpd.book_server = book_server
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    # Reloads a book of which only the yaml file changed, with a
+    # BookCache, and checks that the new book is marked afresh.
+    import shutil
+    import tempfile
+    from koert.gnucash.tools import BookCache
+    print(" *** Testing koert.gnucash.server ***")
+    TEST_GNUCASH = """<?xml version="1.0" encoding="utf-8" ?>
+<gnc-v2
+     xmlns:gnc="http://www.gnucash.org/XML/gnc"
+     xmlns:act="http://www.gnucash.org/XML/act"
+     xmlns:book="http://www.gnucash.org/XML/book"
+     xmlns:cd="http://www.gnucash.org/XML/cd"
+     xmlns:cmdty="http://www.gnucash.org/XML/cmdty"
+     xmlns:split="http://www.gnucash.org/XML/split"
+     xmlns:trn="http://www.gnucash.org/XML/trn"
+     xmlns:ts="http://www.gnucash.org/XML/ts">
+<gnc:count-data cd:type="book">1</gnc:count-data>
+<gnc:book version="2.0.0">
+<book:id type="guid">00000000000000000000000000000001</book:id>
+<gnc:commodity version="2.0.0">
+  <cmdty:space>ISO4217</cmdty:space>
+  <cmdty:id>EUR</cmdty:id>
+</gnc:commodity>
+<gnc:account version="2.0.0">
+  <act:name>Root Account</act:name>
+  <act:id type="guid">00000000000000000000000000000002</act:id>
+  <act:type>ROOT</act:type>
+</gnc:account>
+<gnc:account version="2.0.0">
+  <act:name>Bank</act:name>
+  <act:id type="guid">00000000000000000000000000000003</act:id>
+  <act:type>BANK</act:type>
+  <act:commodity>
+    <cmdty:space>ISO4217</cmdty:space>
+    <cmdty:id>EUR</cmdty:id>
+  </act:commodity>
+  <act:commodity-scu>100</act:commodity-scu>
+  <act:parent type="guid">00000000000000000000000000000002</act:parent>
+</gnc:account>
+<gnc:account version="2.0.0">
+  <act:name>Opening</act:name>
+  <act:id type="guid">00000000000000000000000000000004</act:id>
+  <act:type>EQUITY</act:type>
+  <act:commodity>
+    <cmdty:space>ISO4217</cmdty:space>
+    <cmdty:id>EUR</cmdty:id>
+  </act:commodity>
+  <act:commodity-scu>100</act:commodity-scu>
+  <act:parent type="guid">00000000000000000000000000000002</act:parent>
+</gnc:account>
+<gnc:transaction version="2.0.0">
+  <trn:id type="guid">00000000000000000000000000000005</trn:id>
+  <trn:currency>
+    <cmdty:space>ISO4217</cmdty:space>
+    <cmdty:id>EUR</cmdty:id>
+  </trn:currency>
+  <trn:num>1</trn:num>
+  <trn:date-posted>
+    <ts:date>2014-03-01 00:00:00 +0100</ts:date>
+  </trn:date-posted>
+  <trn:date-entered>
+    <ts:date>2014-03-01 10:00:00 +0100</ts:date>
+  </trn:date-entered>
+  <trn:description>test</trn:description>
+  <trn:splits>
+    <trn:split>
+      <split:id type="guid">00000000000000000000000000000006</split:id>
+      <split:reconciled-state>n</split:reconciled-state>
+      <split:value>1000/100</split:value>
+      <split:quantity>1000/100</split:quantity>
+      <split:account type="guid">00000000000000000000000000000003</split:account>
+    </trn:split>
+    <trn:split>
+      <split:id type="guid">00000000000000000000000000000007</split:id>
+      <split:reconciled-state>n</split:reconciled-state>
+      <split:value>-1000/100</split:value>
+      <split:quantity>-1000/100</split:quantity>
+      <split:account type="guid">00000000000000000000000000000004</split:account>
+    </trn:split>
+  </trn:splits>
+</gnc:transaction>
+</gnc:book>
+</gnc-v2>
+"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tmpdir, "test.gnucash"), "w") as f:
+            f.write(TEST_GNUCASH)
+        yaml_path = os.path.join(tmpdir, "test.yaml")
+
+        def write_yaml(period_from, opening):
+            with open(yaml_path, "w") as f:
+                f.write("path: test.gnucash\nchecks: true\n")
+                f.write("meta:\n  period:\n    from: %s\n    to: 2014-12-31\n"
+                        % (period_from,))
+                if opening:
+                    f.write("opening balance: ':Opening'\n")
+
+        write_yaml("2014-01-01", False)
+        server = BookServer([yaml_path],
+                            cache=BookCache(os.path.join(tmpdir, "cache")))
+        assert server.load("test")
+        old = server.books["test"]
+        assert not old.checks["E03"]["objects"]
+
+        write_yaml("2014-07-01", True)
+        # (the yaml file must look newer than the last load)
+        later = time.time() + 1
+        os.utime(yaml_path, (later, later))
+        assert server.load("test")
+        new = server.books["test"]
+        assert new is not old
+        assert str(new.meta["period"]["from"]) == "2014-07-01"
+        assert str(old.meta["period"]["from"]) == "2014-01-01"
+        assert new.ac_by_path(":Opening").is_opening_balance
+        assert not old.ac_by_path(":Opening").is_opening_balance
+        assert [tr.num for tr in new.checks["E03"]["objects"]] == ["1"]
+        assert not old.checks["E03"]["objects"]
+        print("ok")
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,461 @@
+"""A compact, versioned snapshot format for parsed gnucash files.
+
+A snapshot stores the accounts, transactions and splits of each book
+as flat columns: references between objects are row indices, strings
+are indices into a string table, amounts are scaled integers
+(coefficient, exponent and sign, the last for the sake of -0) and
+dates are whole seconds since the epoch.  Loading it needs no
+recursion: the columns are read from a memory map and the objects are
+rebuilt table by table.  The fingerprints (see gnucash.fingerprint) of
+the books, accounts, transactions and splits are stored as well.
+
+The layout of a snapshot file is
+
+    MAGIC  FORMAT_VERSION  header-length  header  columns
+
+where the header is a JSON object describing the columns; each column
+starts at a multiple of 8 bytes from the start of the columns.
+"""
+
+from .core import File, Book, Account, Transaction, Split, TimeStamp, \
+    Commodity
+from .fingerprint import fingerprint
+from array import array
+from decimal import Decimal
+import json
+import mmap
+import struct
+import sys
+
+MAGIC = b"KOERTSNP"
+FORMAT_VERSION = 3
+
+_PREFIX = struct.Struct("<8sII")
+
+# XML can not contain NUL characters, so they can separate the strings
+_SEP = u"\0"
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class StaleSnapshotError(SnapshotError):
+    """The snapshot was written by another version of the format
+    or for another key."""
+    pass
+
+
+def dump(gcf, f, key=""):
+    strings = _StringTable()
+    columns = _Columns()
+    for name, typecode in _COLUMNS:
+        columns.new(name, typecode)
+    for name in _RANGE_COLUMNS:
+        columns[name].append(0)
+    for book in gcf.books.values():
+        _dump_book(book, columns, strings)
+    columns.seal()
+    columns.add("strings", "B", array("B", _SEP.join(
+        strings.strings).encode("utf-8")))
+    header = {
+        "key": key,
+        "mtime": getattr(gcf, "mtime", None),
+        "byteorder": sys.byteorder,
+        "strings": len(strings.strings),
+        "columns": columns.directory,
+    }
+    header = json.dumps(header, sort_keys=True).encode("utf-8")
+    header += b" " * (-(_PREFIX.size + len(header)) % 8)
+    f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(header)))
+    f.write(header)
+    for data in columns.data:
+        f.write(data.tobytes())
+        f.write(b"\0" * (-len(data) * data.itemsize % 8))
+
+
+def load(f, key=None):
+    """Loads the File from the snapshot in the (binary) file f.
+
+    Raises StaleSnapshotError when the snapshot has another format
+    version or, if key is given, another key."""
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        raise SnapshotError("empty snapshot")
+    try:
+        return _load(mm, key)
+    finally:
+        mm.close()
+
+
+def loads(data, key=None):
+    """Loads the File from the snapshot in the bytes data (see load)."""
+    if not data:
+        raise SnapshotError("empty snapshot")
+    return _load(data, key)
+
+
+# ############# INTERNALS ####################################################
+
+def _load(buf, key):
+    header, columns = _read(buf, key)
+    strings = columns.pop("strings").decode("utf-8").split(_SEP)
+    if len(strings) != header["strings"]:
+        raise SnapshotError("the string table is corrupt")
+    # so that the index -1 yields None
+    strings.append(None)
+    gcf = _load_file(columns, strings)
+    gcf.mtime = header["mtime"]
+    return gcf
+
+def _read(mm, key):
+    if len(mm) < _PREFIX.size:
+        raise SnapshotError("truncated snapshot")
+    magic, version, header_length = _PREFIX.unpack_from(mm)
+    if magic != MAGIC:
+        raise SnapshotError("not a snapshot")
+    if version != FORMAT_VERSION:
+        raise StaleSnapshotError("snapshot has format version %d, "
+                                 "not %d" % (version, FORMAT_VERSION))
+    start = _PREFIX.size + header_length
+    header = json.loads(mm[_PREFIX.size:start].decode("utf-8"))
+    if key is not None and header["key"] != key:
+        raise StaleSnapshotError("snapshot was made for another key")
+    swap = header["byteorder"] != sys.byteorder
+    columns = dict()
+    with memoryview(mm) as buf:
+        for name, (typecode, offset, count) in header["columns"].items():
+            size = count * array(typecode).itemsize
+            begin = start + offset
+            if begin + size > len(mm):
+                raise SnapshotError("truncated snapshot")
+            with buf[begin:begin + size] as view:
+                if typecode == "B":
+                    columns[name] = bytes(view)
+                elif swap:
+                    column = array(typecode)
+                    column.frombytes(view)
+                    column.byteswap()
+                    columns[name] = column.tolist()
+                else:
+                    with view.cast(typecode) as items:
+                        columns[name] = items.tolist()
+    return header, columns
+
+
+class _StringTable(object):
+
+    def __init__(self):
+        self.index = dict()
+        self.strings = []
+
+    def __call__(self, s):
+        if s is None:
+            return -1
+        i = self.index.get(s)
+        if i is None:
+            if _SEP in s:
+                raise SnapshotError("can not store %r" % (s,))
+            i = self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+
+class _Columns(object):
+
+    def __init__(self):
+        self.directory = dict()
+        self.data = []
+        self.size = 0
+        self.columns = dict()
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def new(self, name, typecode):
+        self.columns[name] = array(typecode)
+
+    def add(self, name, typecode, data):
+        self.directory[name] = (typecode, self.size, len(data))
+        self.data.append(data)
+        size = len(data) * data.itemsize
+        self.size += size + (-size % 8)
+
+    def seal(self):
+        for name, column in self.columns.items():
+            self.add(name, column.typecode, column)
+        self.columns = dict()
+
+
+# The columns of a snapshot.  Row ranges (of the accounts of a book,
+# the splits of a transaction, ...) are given by start offsets which
+# have one more entry than the table they belong to.
+_COLUMNS = (
+    ("book.id", "i"),
+    ("book.commodities", "q"),
+    ("book.accounts", "q"),
+    ("book.transactions", "q"),
+    ("cm.space", "i"),
+    ("cm.id", "i"),
+    ("cm.quote_source", "i"),
+    ("ac.name", "i"),
+    ("ac.id", "i"),
+    ("ac.type", "i"),
+    ("ac.parent", "q"),
+    ("ac.description", "i"),
+    ("ac.code", "i"),
+    ("ac.cm.space", "i"),
+    ("ac.cm.id", "i"),
+    ("ac.cm.quote_source", "i"),
+    ("ac.scu", "q"),
+    ("tr.id", "i"),
+    ("tr.description", "i"),
+    ("tr.num", "i"),
+    ("tr.cur.space", "i"),
+    ("tr.cur.id", "i"),
+    ("tr.cur.quote_source", "i"),
+    ("tr.posted", "q"),
+    ("tr.posted.ns", "q"),
+    ("tr.entered", "q"),
+    ("tr.entered.ns", "q"),
+    ("tr.splits", "q"),
+    ("sp.id", "i"),
+    ("sp.value", "q"),
+    ("sp.value.exp", "b"),
+    ("sp.value.sign", "b"),
+    ("sp.quantity", "q"),
+    ("sp.quantity.exp", "b"),
+    ("sp.quantity.sign", "b"),
+    ("sp.account", "q"),
+    ("sp.memo", "i"),
+    ("sp.reconciled_state", "i"),
+    ("book.fp", "B"),
+    ("ac.fp", "B"),
+    ("tr.fp", "B"),
+    ("sp.fp", "B"),
+)
+
+_FP_SIZE = 20
+
+_RANGE_COLUMNS = ("book.commodities", "book.accounts", "book.transactions",
+                  "tr.splits")
+
+# ns column values for a missing ns or a missing timestamp altogether
+_NO_NS = -1
+_NO_TS = -2
+
+_INT64 = (-2 ** 63, 2 ** 63)
+
+
+def _dump_book(book, columns, strings):
+    columns["book.id"].append(strings(book.id))
+    columns["book.fp"].frombytes(fingerprint(book))
+
+    for cm in book.commodities.values():
+        _dump_commodity(cm, columns, "cm", strings)
+    columns["book.commodities"].append(len(columns["cm.id"]))
+
+    ac_rows = dict()
+    first = len(columns["ac.id"])
+    for i, ac in enumerate(book.accounts.values()):
+        ac_rows[ac.id] = first + i
+    for ac in book.accounts.values():
+        columns["ac.name"].append(strings(ac.name))
+        columns["ac.id"].append(strings(ac.id))
+        columns["ac.type"].append(strings(ac.type))
+        columns["ac.parent"].append(-1 if ac.parent_id is None
+                                    else ac_rows[ac.parent_id])
+        columns["ac.description"].append(strings(ac.description))
+        columns["ac.code"].append(strings(ac.code))
+        _dump_commodity(ac.commodity, columns, "ac.cm", strings)
+        columns["ac.scu"].append(-1 if ac.commodity_scu is None
+                                 else ac.commodity_scu)
+        columns["ac.fp"].frombytes(fingerprint(ac))
+    columns["book.accounts"].append(len(columns["ac.id"]))
+
+    for tr in book.transactions.values():
+        columns["tr.id"].append(strings(tr.id))
+        columns["tr.description"].append(strings(tr.description))
+        columns["tr.num"].append(strings(tr.num))
+        _dump_commodity(tr.currency, columns, "tr.cur", strings)
+        _dump_timestamp(tr.date_posted, columns, "tr.posted")
+        _dump_timestamp(tr.date_entered, columns, "tr.entered")
+        columns["tr.fp"].frombytes(fingerprint(tr))
+        for sp in tr.splits.values():
+            columns["sp.id"].append(strings(sp.id))
+            _dump_amount(sp.value, columns, "sp.value")
+            _dump_amount(sp.quantity, columns, "sp.quantity")
+            columns["sp.account"].append(ac_rows[sp.account_id])
+            columns["sp.memo"].append(strings(sp.memo))
+            columns["sp.reconciled_state"].append(
+                strings(sp.reconciled_state))
+            columns["sp.fp"].frombytes(fingerprint(sp))
+        columns["tr.splits"].append(len(columns["sp.id"]))
+    columns["book.transactions"].append(len(columns["tr.id"]))
+
+
+def _dump_commodity(cm, columns, prefix, strings):
+    if cm is None:
+        space = id = quote_source = None
+    else:
+        space, id, quote_source = cm.space, cm.id, cm.quote_source
+    columns[prefix + ".space"].append(strings(space))
+    columns[prefix + ".id"].append(strings(id))
+    columns[prefix + ".quote_source"].append(strings(quote_source))
+
+
+def _dump_timestamp(ts, columns, prefix):
+    if ts is None:
+        columns[prefix].append(0)
+        columns[prefix + ".ns"].append(_NO_TS)
+        return
+    seconds = int(ts.timestamp)
+    if seconds != ts.timestamp:
+        raise SnapshotError("can not store timestamp %r" % (ts.timestamp,))
+    columns[prefix].append(seconds)
+    columns[prefix + ".ns"].append(_NO_NS if ts.ns is None else ts.ns)
+
+
+def _dump_amount(d, columns, prefix):
+    sign, digits, exp = d.as_tuple()
+    coefficient = int(d.scaleb(-exp))
+    if not (_INT64[0] <= coefficient < _INT64[1]) or not (-128 <= exp < 128):
+        raise SnapshotError("can not store amount %s" % (d,))
+    columns[prefix].append(coefficient)
+    columns[prefix + ".exp"].append(exp)
+    columns[prefix + ".sign"].append(sign)
+
+
+def _load_amount(c, prefix, i):
+    d = Decimal(c[prefix][i]).scaleb(c[prefix + ".exp"][i])
+    if c[prefix + ".sign"][i] and not d:
+        # -0, whose sign int() has lost
+        d = d.copy_negate()
+    return d
+
+
+def _load_file(c, s):
+    # shared between the objects, as by the parser
+    commodities = dict()
+    timestamps = dict()
+    books = dict()
+    ac_objs = []
+    tr_start = 0
+    for b, book_id in enumerate(c["book.id"]):
+        book_commodities = dict()
+        for i in range(c["book.commodities"][b],
+                       c["book.commodities"][b + 1]):
+            cm = _load_commodity(c, "cm", i, s, commodities)
+            book_commodities[cm.id] = cm
+
+        accounts = dict()
+        for i in range(c["book.accounts"][b], c["book.accounts"][b + 1]):
+            parent = c["ac.parent"][i]
+            scu = c["ac.scu"][i]
+            ac = Account({
+                "name": s[c["ac.name"][i]],
+                "id": s[c["ac.id"][i]],
+                "type": s[c["ac.type"][i]],
+                "parent": None if parent == -1 else s[c["ac.id"][parent]],
+                "description": s[c["ac.description"][i]],
+                "code": s[c["ac.code"][i]],
+                "commodity": _load_commodity(c, "ac.cm", i, s, commodities),
+                "commodity-scu": None if scu == -1 else scu,
+            })
+            ac._fingerprint = _fp(c["ac.fp"], i)
+            ac_objs.append(ac)
+            accounts[ac.id] = ac
+
+        transactions = dict()
+        sp_start = c["tr.splits"][tr_start]
+        tr_end = c["book.transactions"][b + 1]
+        for i in range(tr_start, tr_end):
+            sp_end = c["tr.splits"][i + 1]
+            splits = dict()
+            for j in range(sp_start, sp_end):
+                value = _load_amount(c, "sp.value", j)
+                quantity = value
+                if c["sp.quantity"][j] != c["sp.value"][j] or \
+                        c["sp.quantity.exp"][j] != c["sp.value.exp"][j] or \
+                        c["sp.quantity.sign"][j] != c["sp.value.sign"][j]:
+                    quantity = _load_amount(c, "sp.quantity", j)
+                sp = Split({
+                    "id": s[c["sp.id"][j]],
+                    "value": value,
+                    "quantity": quantity,
+                    "account": ac_objs[c["sp.account"][j]].id,
+                    "memo": s[c["sp.memo"][j]],
+                    "reconciled-state": s[c["sp.reconciled_state"][j]],
+                })
+                sp._fingerprint = _fp(c["sp.fp"], j)
+                splits[sp.id] = sp
+            sp_start = sp_end
+            tr = Transaction({
+                "id": s[c["tr.id"][i]],
+                "description": s[c["tr.description"][i]],
+                "num": s[c["tr.num"][i]],
+                "splits": splits,
+                "currency": _load_commodity(c, "tr.cur", i, s, commodities),
+                "date-posted": _load_timestamp(c, "tr.posted", i,
+                                               timestamps),
+                "date-entered": _load_timestamp(c, "tr.entered", i,
+                                                timestamps),
+            })
+            tr._fingerprint = _fp(c["tr.fp"], i)
+            transactions[tr.id] = tr
+        tr_start = tr_end
+
+        book = Book({
+            "id": s[book_id],
+            "accounts": accounts,
+            "transactions": transactions,
+            "commodities": book_commodities,
+        })
+        book._fingerprint = _fp(c["book.fp"], b)
+        books[book.id] = book
+    return File({"books": books})
+
+
+def _fp(column, i):
+    return column[i * _FP_SIZE:(i + 1) * _FP_SIZE]
+
+
+def _load_commodity(c, prefix, i, s, commodities):
+    id = c[prefix + ".id"][i]
+    if id == -1:
+        return None
+    key = (c[prefix + ".space"][i], id, c[prefix + ".quote_source"][i])
+    cm = commodities.get(key)
+    if cm is None:
+        cm = commodities[key] = Commodity({
+            "space": s[key[0]],
+            "id": s[id],
+            "quote_source": s[key[2]],
+        })
+    return cm
+
+
+def _load_timestamp(c, prefix, i, timestamps):
+    ns = c[prefix + ".ns"][i]
+    if ns == _NO_TS:
+        return None
+    key = (c[prefix][i], ns)
+    ts = timestamps.get(key)
+    if ts is None:
+        ts = timestamps[key] = TimeStamp({
+            "date": float(key[0]),
+            "ns": None if ns == _NO_NS else ns,
+        })
+    return ts
+
+
+if __name__ == "__main__":
+    print(" *** Testing koert.gnucash.snapshot ***")
+    for text in ("-0.00", "0.00", "-0", "-1.50", "12", "1E+3"):
+        columns = {"x": [], "x.exp": [], "x.sign": []}
+        _dump_amount(Decimal(text), columns, "x")
+        d = _load_amount(columns, "x", 0)
+        print("%s -> %s" % (text, d))
+        assert d.as_tuple() == Decimal(text).as_tuple()
+    print("ok")
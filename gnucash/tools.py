@@ -1,18 +1,21 @@
-from koert.gnucash.xmlformat import SaxHandler
+from koert.gnucash.xmlformat import SaxHandler, StreamingSaxHandler, \
+    TransactionsSaxHandler
+from koert.gnucash import snapshot
 from koert.checks import core as checks
 import gzip
+import hashlib
 import os.path
-import pickle
 import sys
+import threading
 import yaml
 import io
+from collections import OrderedDict
 from warnings import warn
-from subprocess import Popen, PIPE
 from git import Repo
 
 
 def open_gcf_in_git_repo(repopath, filepath, cachepath=None, \
-        updatecache=True, onlyafter=None):
+        updatecache=True, onlyafter=None, cache=None):
 
     repo = Repo(repopath)
     commit = repo.head.commit
@@ -21,10 +24,22 @@ def open_gcf_in_git_repo(repopath, filepath, cachepath=None, \
     if onlyafter!=None and mtime <= onlyafter:
         return None
 
-    f = io.BytesIO(commit.tree[filepath].data_stream.read())
+    blob = commit.tree[filepath]
 
-    result = parse_gcf(f, mtime, cachepath=cachepath, \
-            updatecache=updatecache)
+    if cache is None and cachepath is not None:
+        cache = CacheFile(cachepath)
+
+    # the blob need not be read when the cache is fresh
+    if cache is not None:
+        result = cache.load(blob.hexsha)
+        if result:
+            result.mtime = mtime
+            return result
+
+    f = io.BytesIO(blob.data_stream.read())
+
+    result = parse_gcf(f, mtime, updatecache=updatecache, key=blob.hexsha,
+            cache=cache)
 
     return result
 
@@ -48,6 +63,111 @@ def saxparse(f, handler):
     saxparse(f, handler)
 
 
+def expatparse(f, handler):
+    from koert.sax.expat import parse as expatparse
+    expatparse(f, handler)
+
+
+# Parses the transactions of the gnucash file in a pool of worker
+# processes.  The file is scanned for the <gnc:transaction> elements
+# of the book; the remainder (accounts, commodities, ...) is parsed by
+# handler (which must be a SaxHandler), while the transactions are
+# divided into runs of about equal size that are parsed by the workers.
+# The transactions are then added to the book in their original order.
+def parallelparse(f, handler, workers=None):
+    from koert.sax.expat import parse as expatparse
+    from concurrent.futures import ProcessPoolExecutor
+    data = f.read()
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    if workers is None:
+        workers = os.cpu_count() or 1
+    spans = _transaction_spans(data)
+    if workers <= 1 or len(spans) < 2:
+        expatparse(io.BytesIO(data), handler)
+        return
+    header = []
+    previous = 0
+    for start, end in spans:
+        header.append(data[previous:start])
+        previous = end
+    header.append(data[previous:])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_parse_transactions,
+                               _transaction_runs(data, spans, workers * 4))
+        expatparse(io.BytesIO(b"".join(header)), handler)
+        books = list(handler.result.books.values())
+        if len(books) != 1:
+            raise ValueError("parallelparse can only handle "
+                             "a file with one book")
+        book = books[0]
+        for trs in results:
+            for tr in trs:
+                book._add_transaction(tr)
+
+
+_TR_START = b"<gnc:transaction"
+_TR_END = b"</gnc:transaction>"
+_TEMPLATE_START = b"<gnc:template-transactions"
+_TEMPLATE_END = b"</gnc:template-transactions>"
+
+
+# Returns the (start, end) byte offsets of the transactions of the book,
+# skipping the template transactions of scheduled transactions.
+def _transaction_spans(data):
+    spans = []
+    pos = 0
+    template = data.find(_TEMPLATE_START)
+    while True:
+        start = data.find(_TR_START, pos)
+        if start == -1:
+            break
+        if template != -1 and template < start:
+            pos = data.find(_TEMPLATE_END, template)
+            if pos == -1:
+                raise ValueError("unterminated template transactions")
+            template = data.find(_TEMPLATE_START, pos)
+            continue
+        pos = start + len(_TR_START)
+        if data[pos:pos + 1] not in (b" ", b">", b"\n", b"\r", b"\t"):
+            continue
+        end = data.find(_TR_END, pos)
+        if end == -1:
+            raise ValueError("unterminated transaction at byte %d" % start)
+        pos = end + len(_TR_END)
+        spans.append((start, pos))
+    return spans
+
+
+def _transaction_runs(data, spans, count):
+    declaration = b""
+    if data.startswith(b"<?xml"):
+        declaration = data[:data.find(b"?>") + 2]
+    size = (spans[-1][1] - spans[0][0]) // count + 1
+    run = []
+    run_start = spans[0][0]
+    for start, end in spans:
+        run.append(data[start:end])
+        if end - run_start >= size:
+            yield _wrap_transactions(declaration, run)
+            run = []
+            run_start = end
+    if run:
+        yield _wrap_transactions(declaration, run)
+
+
+def _wrap_transactions(declaration, run):
+    return b"".join([declaration, b"<transactions>"] + run
+                    + [b"</transactions>"])
+
+
+def _parse_transactions(data):
+    from koert.sax.expat import parse as expatparse
+    handler = TransactionsSaxHandler()
+    expatparse(io.BytesIO(data), handler)
+    return handler.result
+
+
 def lxmlparse(f, handler):
     from lxml.etree import parse as lxmlparse
     from lxml.sax import saxify
@@ -56,89 +176,287 @@ def lxmlparse(f, handler):
 
 
 def cache_path(filepath):
-    return filepath + ".pickled"
+    return filepath + ".snapshot"
+
+
+# The caches are keyed by the content of the gnucash file, in the form
+# of its git blob SHA (so that a file and its commit in a repository
+# share their cache), together with KOERT_VERSION, which identifies the
+# code that determines the parsed objects and the snapshot format.
+
+def _koert_version():
+    h = hashlib.sha1(b"snapshot %d\n" % snapshot.FORMAT_VERSION)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for name in ("sax/core.py", "sax/switch.py", "sax/expat.py",
+                 "gnucash/core.py", "gnucash/xmlformat.py",
+                 "gnucash/snapshot.py", "gnucash/fingerprint.py"):
+        with open(os.path.join(root, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+KOERT_VERSION = _koert_version()
+
+
+def blob_key(data):
+    h = hashlib.sha1(b"blob %d\0" % len(data))
+    h.update(data)
+    return h.hexdigest()
+
 
+_file_keys = dict()
 
-def get_commit_name():
-    directory = os.path.dirname(__file__)
-    p = Popen('git rev-parse HEAD',
-              stdout=PIPE, shell=True, cwd=directory)
-    outp, err = p.communicate()
-    return outp
 
+# Returns the git blob SHA of the file at filepath.  The hash is only
+# recomputed when the file's size, mtime or inode changed since the
+# previous call, so checking a file for changes costs a single stat.
+def file_key(filepath):
+    st = os.stat(filepath)
+    signature = (st.st_size, st.st_mtime_ns, st.st_ino)
+    known = _file_keys.get(filepath)
+    if known is not None and known[0] == signature:
+        return known[1]
+    h = hashlib.sha1(b"blob %d\0" % st.st_size)
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    key = h.hexdigest()
+    _file_keys[filepath] = (signature, key)
+    return key
 
-def load_cache(cachepath, mtime):
-    if not os.path.exists(cachepath):
+
+def _cache_key(key):
+    return "%s:%s" % (KOERT_VERSION, key)
+
+
+# Loads the snapshot at cachepath, or, when given, the snapshot data
+# read from it before.
+def load_cache(cachepath, key, data=None):
+    if data is None and not os.path.exists(cachepath):
+        return False
+    try:
+        if data is None:
+            with open(cachepath, "rb") as f:
+                gcf = snapshot.load(f, key=_cache_key(key))
+        else:
+            gcf = snapshot.loads(data, key=_cache_key(key))
+    except snapshot.StaleSnapshotError:
         return False
-    # Do not use the cache if the gnucash file is newer
-    if mtime >= os.path.getmtime(cachepath):
+    except Exception as e:
+        warn("Failed to load the cache of Gnucash file "
+             "'%s': %s" % (cachepath, repr(e)))
         return False
-    with open(cachepath, "rb") as f:
-        current_commit_name = get_commit_name()
-        try:
-            cached_commit_name, gcf = pickle.load(f)
-            if cached_commit_name != current_commit_name:
-                return False
-            print("loaded cache %s" % cachepath)
-            return gcf
-        except Exception as e:
-            warn("Failed to load pickled cache of Gnucash file "
-                 "'%s': %s" % (cachepath, repr(e)))
-            return False
-
-
-def update_cache(cachepath, gcf):
-    if sys.getrecursionlimit() < 4000:
-        sys.setrecursionlimit(4000)
-    with open(cachepath, "wb") as f:
-        try:
-            pickle.dump((get_commit_name(), gcf), f)
-        except RuntimeError as e:
-            warn("""Failed to dump a pickled version of the \
-gnucash file "%s" due to the RuntimeError below.  If this is a stack \
-overflow, you might want to increase the maximum recursion depth by \
-sys.setrecursionlimit.""")
-            raise e
-
-
-def parse_gcf(f, mtime, parse=saxparse, cachepath=None, updatecache=True):
-    if cachepath is not None:
-        result = load_cache(cachepath, mtime)
+    # (on stderr, so that it does not mix with the output of scripts)
+    sys.stderr.write("loaded cache %s\n" % (cachepath,))
+    return gcf
+
+
+# The snapshot is written to a temporary file first, so that readers
+# never see a partially written cache.  Returns the snapshot data, or
+# None when it could not be written.
+def update_cache(cachepath, gcf, key):
+    tmppath = "%s.%d.tmp" % (cachepath, os.getpid())
+    try:
+        f = io.BytesIO()
+        snapshot.dump(gcf, f, key=_cache_key(key))
+        data = f.getvalue()
+        with open(tmppath, "wb") as f:
+            f.write(data)
+        os.replace(tmppath, cachepath)
+        return data
+    except snapshot.SnapshotError as e:
+        warn("Failed to write the cache of Gnucash file "
+             "'%s': %s" % (cachepath, repr(e)))
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+
+class CacheFile(object):
+    """A cache consisting of the single snapshot at path."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, key):
+        return load_cache(self.path, key) or None
+
+    def store(self, key, gcf):
+        update_cache(self.path, gcf, key)
+
+
+class BookCache(object):
+    """A directory of snapshots keyed by the content of the gnucash files.
+
+    When the snapshots together take more than max_size bytes, the
+    least recently used ones are removed.  The max_in_memory most
+    recently used snapshots are also kept in memory, so that loading
+    them again does not touch the disk.  Each load gives a File of its
+    own, which the caller may change.  See also get_book_cache."""
+
+    def __init__(self, directory, max_size=1 << 30, max_in_memory=4):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_in_memory = max_in_memory
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory,
+                            _cache_key(key).replace(":", "-") + ".snapshot")
+
+    def load(self, key):
+        path = self.path(key)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+        if data is None:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except (IOError, OSError):
+                return None
+            # the mtimes of the snapshots record their use
+            os.utime(path)
+        gcf = load_cache(path, key, data=data)
+        if not gcf:
+            return None
+        self._remember(key, data)
+        return gcf
+
+    def store(self, key, gcf):
+        data = update_cache(self.path(key), gcf, key)
+        if data is not None:
+            self._remember(key, data)
+        self.evict(keep=self.path(key))
+
+    def _remember(self, key, data):
+        if self.max_in_memory <= 0:
+            return
+        with self._lock:
+            self._memory[key] = data
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_in_memory:
+                self._memory.popitem(last=False)
+
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".snapshot"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+
+
+_book_caches = dict()
+
+
+# Returns the BookCache for directory, creating it on first use, so
+# that the memory tier is shared by all users of the directory.
+def get_book_cache(directory, **kwargs):
+    directory = os.path.abspath(directory)
+    if directory not in _book_caches:
+        _book_caches[directory] = BookCache(directory, **kwargs)
+    return _book_caches[directory]
+
+
+# The cache is keyed by key, which is computed from the contents of f
+# when not given (see file_key).  If cache is given, it is used instead
+# of cachepath.
+def parse_gcf(f, mtime, parse=saxparse, cachepath=None, updatecache=True,
+              key=None, cache=None):
+    if cache is None and cachepath is not None:
+        cache = CacheFile(cachepath)
+    if cache is not None:
+        if key is None:
+            data = f.read()
+            if not isinstance(data, bytes):
+                data = data.encode("utf-8")
+            key = blob_key(data)
+            f = io.BytesIO(data)
+        result = cache.load(key)
         if result:
+            result.mtime = mtime
             return result
     handler = SaxHandler()
     parse(f, handler)
     result = handler.result
     result.mtime = mtime
-    if cachepath is not None:
+    if cache is not None:
         if updatecache:
-            update_cache(cachepath, result)
+            cache.store(key, result)
     return result
 
 
 def open_gcf(filepath, parse=saxparse, cachepath=None, updatecache=True, \
-        onlyafter=None):
+        onlyafter=None, cache=None):
 
     mtime = os.path.getmtime(filepath)
     if onlyafter!=None and mtime <= onlyafter:
         return None
-    if cachepath is None:
+    if cachepath is None and cache is None:
         cachepath = cache_path(filepath)
-    with open(filepath) as f:
+    key = file_key(filepath)
+    with open(filepath, "rb") as f:
         return parse_gcf(f, mtime,
                          parse=parse, cachepath=cachepath,
-                         updatecache=updatecache)
+                         updatecache=updatecache, key=key, cache=cache)
+
+
+def iter_gcf(filepath):
+    """Yields the accounts of the gnucash file at filepath, followed by
+    its transactions, each as soon as it has been parsed.
 
+    The transactions are not kept in the book, nor registered with
+    their accounts, so memory use does not grow with the size of
+    the file."""
+    from koert.sax.expat import feed
+    handler = StreamingSaxHandler()
+    with open(filepath, "rb") as f:
+        for _ in feed(f, handler):
+            while handler.queue:
+                yield handler.queue.popleft()
 
-def open_yaml(path, onlyafter=None):
+
+def open_yaml(path, onlyafter=None, cache=None, previous=None):
     """Loads a gnucash file specified in a yaml file with extra metadata.
 
     If onlyafter is not None, returns None if both the yaml file and
     the (commit of the) gnucash file it points to are older than
-    time onlyafter."""
+    time onlyafter.
+
+    The parsed file is cached in cache (a BookCache) if given, else in
+    the directory 'cache_dir' or the file 'cache' of the yaml file.
+
+    If previous, an earlier version of the book, is given, only the
+    parts of the book that changed since are checked again."""
 
     with open(path) as f:
-        d = yaml.load(f)
+        d = yaml.safe_load(f)
 
     yamltime = os.path.getmtime(path)
     
@@ -152,15 +470,18 @@ def open_yaml(path, onlyafter=None):
     cache_path = None
     if "cache" in d:
         cache_path = os.path.join(dirname, d['cache'])
+    if cache is None and "cache_dir" in d:
+        cache = get_book_cache(os.path.join(dirname, d['cache_dir']))
     gcf = None
     if 'repo' in d:
         repo_path = os.path.join(dirname, d['repo'])
         gcf = open_gcf_in_git_repo(repo_path, d['path'], cachepath=cache_path,
-                updatecache=True, onlyafter=onlyafter)
+                updatecache=True, onlyafter=onlyafter, cache=cache)
         if gcf==None:
             return None
     else:
-        gcf = open_gcf(gcf_path, cachepath=cache_path, onlyafter=onlyafter)
+        gcf = open_gcf(gcf_path, cachepath=cache_path, onlyafter=onlyafter,
+                cache=cache)
         if gcf==None:
             return None
 
@@ -172,8 +493,10 @@ def open_yaml(path, onlyafter=None):
         gcf.book.ac_by_path(d['opening balance']).is_opening_balance = True
     if 'census' in d:
         gcf.book.apply_census(**d['census'])
+    if d.get('scaled_ints'):
+        gcf.book.use_scaled_ints()
     if 'checks' in d:
         if d['checks']:
-            checks.mark_all(gcf.book)
+            checks.mark_all(gcf.book, previous=previous)
 
     return gcf
@@ -2,19 +2,38 @@ from .core import Book, Account, Transaction, Split, TimeStamp, File, \
     Commodity
 from koert.sax.core import StackingHandler, CharactersSH, TimeSH, \
     IntSH, FractionSH
-from koert.sax.switch import SwitchSH, DictCase, SingleCase, NoCase
+from koert.sax.switch import SwitchSH, DictCase, SingleCase, ListCase, \
+    NoCase
+from collections import deque
+
+
+# The handlers below share equal commodities and timestamps via the
+# dicts  commodities  and  timestamps  of the StackingHandler, if it
+# has them.
+
+def _interned(sh, table, key, cls, fields):
+    table = getattr(sh, table, None)
+    if table is None:
+        return cls(fields)
+    obj = table.get(key)
+    if obj is None:
+        obj = table[key] = cls(fields)
+    return obj
 
 
 class SaxHandler(StackingHandler):
 
     def __init__(self):
         StackingHandler.__init__(self, PreGncSH)
+        self.commodities = dict()
+        self.timestamps = dict()
 
 
 class PreGncSH(SwitchSH):
 
-    def __init__(self, ot):
-        SwitchSH.__init__(self, ot, {"gnc-v2": SingleCase("gnc", GncSH)})
+    @staticmethod
+    def create_cases():
+        return {"gnc-v2": SingleCase("gnc", GncSH)}
 
     def post_result(self, sh, result):
         SwitchSH.post_result(self, sh, result['gnc'])
@@ -22,11 +41,12 @@ class PreGncSH(SwitchSH):
 
 class GncSH(SwitchSH):
 
-    def __init__(self, ot):
-        SwitchSH.__init__(self, ot, {
+    @staticmethod
+    def create_cases():
+        return {
             "book": DictCase("books", BookSH,
                              lambda bk: bk.id),
-            "count-data": NoCase})
+            "count-data": NoCase}
 
     def post_result(self, sh, result):
         SwitchSH.post_result(self, sh, File(result))
@@ -34,8 +54,9 @@ class GncSH(SwitchSH):
 
 class BookSH(SwitchSH):
 
-    def __init__(self, ot):
-        SwitchSH.__init__(self, ot, {
+    @staticmethod
+    def create_cases():
+        return {
             "id": SingleCase("id", CharactersSH, True),
             "account": DictCase("accounts", AccountSH,
                                 lambda ac: ac.id),
@@ -44,7 +65,7 @@ class BookSH(SwitchSH):
             "count-data": NoCase,
             "commodity": DictCase("commodities", CommoditySH,
                                   lambda cm: cm.id),
-            "budget": NoCase})
+            "budget": NoCase}
 
     def post_result(self, sh, result):
         SwitchSH.post_result(self, sh, Book(result))
@@ -52,23 +73,28 @@ class BookSH(SwitchSH):
 
 class CommoditySH(SwitchSH):
 
-    def __init__(self, ot):
-        SwitchSH.__init__(self, ot, {
+    @staticmethod
+    def create_cases():
+        return {
             "space": SingleCase("space", CharactersSH),
             "id": SingleCase("id", CharactersSH, True),
             "get_quotes": NoCase,
             "quote_source": SingleCase("quote_source",
                                        CharactersSH),
-            "quote_tz": NoCase})
+            "quote_tz": NoCase}
 
     def post_result(self, sh, result):
-        SwitchSH.post_result(self, sh, Commodity(result))
+        SwitchSH.post_result(self, sh, _interned(
+            sh, "commodities",
+            (result['space'], result['id'], result['quote_source']),
+            Commodity, result))
 
 
 class AccountSH(SwitchSH):
 
-    def __init__(self, ot):
-        SwitchSH.__init__(self, ot, {
+    @staticmethod
+    def create_cases():
+        return {
             "name": SingleCase("name", CharactersSH, True),
             "id": SingleCase("id", CharactersSH, True),
             "type": SingleCase("type", CharactersSH, True),
@@ -81,7 +107,7 @@ class AccountSH(SwitchSH):
             "commodity-scu": SingleCase("commodity-scu",
                                         IntSH),
             "slots": NoCase
-        })
+        }
 
     def post_result(self, sh, result):
         SwitchSH.post_result(self, sh, Account(result))
@@ -89,8 +115,9 @@ class AccountSH(SwitchSH):
 
 class TransactionSH(SwitchSH):
 
-    def __init__(self, ot):
-        SwitchSH.__init__(self, ot, {
+    @staticmethod
+    def create_cases():
+        return {
             "id": SingleCase("id", CharactersSH, True),
             "description": SingleCase("description",
                                       CharactersSH),
@@ -102,7 +129,7 @@ class TransactionSH(SwitchSH):
             "date-posted": SingleCase(
                 "date-posted", TimeStampSH),
             "date-entered": SingleCase(
-                "date-entered", TimeStampSH)})
+                "date-entered", TimeStampSH)}
 
     def post_result(self, sh, result):
         SwitchSH.post_result(self, sh, Transaction(result))
@@ -110,9 +137,10 @@ class TransactionSH(SwitchSH):
 
 class SplitsSH(SwitchSH):
 
-    def __init__(self, ot):
-        SwitchSH.__init__(self, ot, {
-            "split": DictCase("splits", SplitSH, lambda s: s.id)})
+    @staticmethod
+    def create_cases():
+        return {
+            "split": DictCase("splits", SplitSH, lambda s: s.id)}
 
     def post_result(self, sh, result):
         SwitchSH.post_result(self, sh, result['splits'])
@@ -120,8 +148,9 @@ class SplitsSH(SwitchSH):
 
 class SplitSH(SwitchSH):
 
-    def __init__(self, ot):
-        SwitchSH.__init__(self, ot, {
+    @staticmethod
+    def create_cases():
+        return {
             "id": SingleCase("id", CharactersSH, True),
             "value": SingleCase("value", FractionSH, True),
             "quantity": SingleCase("quantity",
@@ -131,19 +160,122 @@ class SplitSH(SwitchSH):
             "memo": SingleCase("memo", CharactersSH),
             "reconciled-state": SingleCase(
                 "reconciled-state", CharactersSH)
-        })
+        }
 
     def post_result(self, sh, result):
+        # usually the quantity equals the value
+        if result['quantity'].as_tuple() == result['value'].as_tuple():
+            result['quantity'] = result['value']
         SwitchSH.post_result(self, sh, Split(result))
 
 
 class TimeStampSH(SwitchSH):
 
-    def __init__(self, ot):
-        SwitchSH.__init__(self, ot, {
+    @staticmethod
+    def create_cases():
+        return {
             "date": SingleCase("date", TimeSH, True),
             "ns": SingleCase("ns", IntSH)
-        })
+        }
+
+    def post_result(self, sh, result):
+        SwitchSH.post_result(self, sh, _interned(
+            sh, "timestamps", (result['date'], result['ns']),
+            TimeStamp, result))
+
+
+# Handles a run of transactions wrapped in a <transactions> element,
+# as cut out of a Gnucash file by tools.parallelparse.
+
+class TransactionsSaxHandler(StackingHandler):
+
+    def __init__(self):
+        StackingHandler.__init__(self, PreTransactionsSH)
+        self.commodities = dict()
+        self.timestamps = dict()
+
+
+class PreTransactionsSH(SwitchSH):
+
+    @staticmethod
+    def create_cases():
+        return {"transactions": SingleCase("transactions", TransactionsSH)}
 
     def post_result(self, sh, result):
-        SwitchSH.post_result(self, sh, TimeStamp(result))
+        SwitchSH.post_result(self, sh, result['transactions'])
+
+
+class TransactionsSH(SwitchSH):
+
+    @staticmethod
+    def create_cases():
+        return {"transaction": ListCase("transactions", TransactionSH)}
+
+    def post_result(self, sh, result):
+        SwitchSH.post_result(self, sh, result['transactions'])
+
+
+# The streaming variant of SaxHandler does not build the transactions
+# of the book, but hands them one by one to its queue, right after
+# the accounts of the book (see tools.iter_gcf).
+
+class StreamingSaxHandler(StackingHandler):
+
+    # timestamps are not shared, as their number grows with the file
+    def __init__(self):
+        StackingHandler.__init__(self, StreamingPreGncSH)
+        self.queue = deque()
+        self.commodities = dict()
+
+
+class StreamingPreGncSH(PreGncSH):
+
+    @staticmethod
+    def create_cases():
+        return {"gnc-v2": SingleCase("gnc", StreamingGncSH)}
+
+
+class StreamingGncSH(GncSH):
+
+    @staticmethod
+    def create_cases():
+        return {
+            "book": DictCase("books", StreamingBookSH,
+                             lambda bk: bk.id),
+            "count-data": NoCase}
+
+
+class StreamingBookSH(BookSH):
+
+    def __init__(self, ot):
+        BookSH.__init__(self, ot)
+        self.book = None
+
+    # The accounts precede the transactions in a Gnucash file, so the
+    # book is created (without transactions) just before the first
+    # transaction is handled.
+    def _start_book(self, sh):
+        self.book = Book(self.table.final_results(self.child_results))
+        sh.queue.extend(self.book.accounts.values())
+
+    def endElement(self, sh, name, spawned_handler):
+        if name != "transaction":
+            BookSH.endElement(self, sh, name, spawned_handler)
+            return
+        tr = spawned_handler.result
+        if tr is None:
+            return
+        if self.book is None:
+            self._start_book(sh)
+        for sp in tr.splits.values():
+            self.book._link_split(sp, tr)
+        sh.queue.append(tr)
+
+    def goodbye(self, sh):
+        if self.book is None:
+            self._start_book(sh)
+        SwitchSH.post_result(self, sh, self.book)
+
+    def reclaim(self):
+        self.book = None
+        return BookSH.reclaim(self)
@@ -0,0 +1,55 @@
+from xml.parsers.expat import ParserCreate
+
+# Drives a StackingHandler with pyexpat directly, skipping the
+# xml.sax.expatreader adapter and its AttributesImpl objects.
+
+READ_SIZE = 1 << 20
+TEXT_BUFFER_SIZE = 1 << 16
+
+
+def create_parser(handler):
+    names = dict()
+    local_names = dict()
+
+    def local_name(name):
+        try:
+            return local_names[name]
+        except KeyError:
+            ln = name.split(":", 1)[-1]
+            ln = local_names[name] = names.setdefault(ln, ln)
+            return ln
+
+    def start(name, attrs):
+        handler.startElement_base(local_name(name), attrs)
+
+    def end(name):
+        handler.endElement_base(local_name(name))
+
+    parser = ParserCreate(intern=names)
+    parser.buffer_text = True
+    parser.buffer_size = TEXT_BUFFER_SIZE
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = handler.characters
+    return parser
+
+
+# Parses f, yielding after each chunk that has been read, so that
+# the caller can pick up the results that have been produced so far.
+def feed(f, handler, read_size=READ_SIZE):
+    parser = create_parser(handler)
+    handler.startDocument()
+    while True:
+        data = f.read(read_size)
+        if not data:
+            break
+        parser.Parse(data, False)
+        yield
+    parser.Parse(b"", True)
+    handler.endDocument()
+    yield
+
+
+def parse(f, handler, read_size=READ_SIZE):
+    for _ in feed(f, handler, read_size):
+        pass
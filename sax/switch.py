@@ -1,5 +1,12 @@
 from .core import SH
 
+# A case describes what a SwitchSH does with the result of one kind of
+# child node.  The results of the child nodes are collected in a list
+# with one slot per case (see CaseTable), which is turned into a dict,
+# keyed by the names of the cases, once the SwitchSH is done.
+
+_UNSET = object()
+
 
 class BaseCase(object):
 
@@ -7,20 +14,28 @@ class BaseCase(object):
         self.name = name
         self.handler = handler
 
+    # whether the slot needs a fresh container for each node
+    container = False
+
+    def init(self):
+        return _UNSET
+
+    def final(self, value):
+        return value
+
 
 class ListCase(BaseCase):
 
+    container = True
+
     def __init__(self, name, handler):
         BaseCase.__init__(self, name, handler)
 
-    def apply_result(self, result, cr):
-        cr[self.name].append(result)
-
-    def init(self, cr):
-        cr[self.name] = []
+    def apply_result(self, result, cr, slot):
+        cr[slot].append(result)
 
-    def final(self, cr):
-        pass
+    def init(self):
+        return []
 
 
 class SingleCase(BaseCase):
@@ -29,43 +44,39 @@ class SingleCase(BaseCase):
         BaseCase.__init__(self, name, handler)
         self.mandatory = mandatory
 
-    def apply_result(self, result, cr):
-        if self.name in cr:
-            raise ValueError("%s has double values; " +
+    def apply_result(self, result, cr, slot):
+        if cr[slot] is not _UNSET:
+            raise ValueError("%s has double values; "
                              "they are %s and %s" % (self.name,
-                                                     result, cr[self.name]))
-        cr[self.name] = result
-
-    def init(self, cr):
-        pass
+                                                     result, cr[slot]))
+        cr[slot] = result
 
-    def final(self, cr):
-        if self.name not in cr:
-            if self.mandatory:
-                raise ValueError("The field %s is manditory, "
-                                 "but hasn't been set"
-                                 % self.name)
-                assert(self.name in cr)
-            else:
-                cr[self.name] = None
+    def final(self, value):
+        if value is not _UNSET:
+            return value
+        if self.mandatory:
+            raise ValueError("The field %s is manditory, "
+                             "but hasn't been set"
+                             % self.name)
+        return None
 
 
 class DictCase(BaseCase):
 
+    container = True
+
     def __init__(self, name, handler, key):
         BaseCase.__init__(self, name, handler)
         self.key = key
 
-    def apply_result(self, result, cr):
+    def apply_result(self, result, cr, slot):
+        d = cr[slot]
         k = self.key(result)
-        assert(k not in cr[self.name])
-        cr[self.name][k] = result
+        assert(k not in d)
+        d[k] = result
 
-    def init(self, cr):
-        cr[self.name] = dict()
-
-    def final(self, cr):
-        pass
+    def init(self):
+        return dict()
 
 
 class NoCase(BaseCase):
@@ -73,54 +84,100 @@ class NoCase(BaseCase):
     def __init__(self):
         BaseCase.__init__(self, "n/a", SH)
 
-    def apply_result(self, result, cr):
+    def apply_result(self, result, cr, slot):
         pass
 
-    def init(self, cr):
-        pass
 
-    def final(self, cr):
-        pass
+NoCase = NoCase()
 
 
-NoCase = NoCase()
+class CaseTable(object):
+    """The cases of a SwitchSH compiled to a lookup table.
+
+    lut maps a node-name to (slot index, handler type, case);
+    NoCase gets no slot."""
+
+    def __init__(self, cases):
+        self.lut = dict()
+        self.cases = []
+        slots = dict()
+        for name, case in cases.items():
+            if case is NoCase:
+                self.lut[name] = (None, case.handler, case)
+                continue
+            if id(case) not in slots:
+                slots[id(case)] = len(self.cases)
+                self.cases.append(case)
+            self.lut[name] = (slots[id(case)], case.handler, case)
+        self.names = tuple(case.name for case in self.cases)
+        self.template = [case.init() for case in self.cases]
+        self.containers = tuple((slot, case) for slot, case
+                                in enumerate(self.cases) if case.container)
+
+    def new_results(self):
+        cr = []
+        self.reset_results(cr)
+        return cr
+
+    def reset_results(self, cr):
+        cr[:] = self.template
+        for slot, case in self.containers:
+            cr[slot] = case.init()
+
+    def final_results(self, cr):
+        return dict(zip(self.names,
+                        [case.final(value) for case, value
+                         in zip(self.cases, cr)]))
 
 
 class SwitchSH(SH):
+    """Dispatches child nodes to handlers by their name.
+
+    The cases are either passed to the constructor, or given by the
+    create_cases of the subclass, in which case they are compiled only
+    once per subclass."""
 
-    def __init__(self, ot, cases, default=NoCase):
+    def __init__(self, ot, cases=None, default=NoCase):
         SH.__init__(self, ot)
-        self.cases = cases
-        self.default = default
-        self.child_results = dict()
-        self.init_child_results()
-
-    def init_child_results(self):
-        for case in self.cases.values():
-            case.init(self.child_results)
-
-    def get_case(self, name):
-        if name in self.cases:
-            return self.cases[name]
+        if cases is None:
+            self.table = self.get_table()
+        else:
+            self.table = CaseTable(cases)
+        self.lut = self.table.lut
+        self.default = (None, default.handler, default)
+        self.child_results = self.table.new_results()
+
+    @classmethod
+    def get_table(cls):
+        table = cls.__dict__.get("_table")
+        if table is None:
+            create_cases = getattr(cls, "create_cases", None)
+            if create_cases is None:
+                raise TypeError("%s has no cases" % cls.__name__)
+            table = cls._table = CaseTable(create_cases())
+        return table
+
+    def get_entry(self, name):
+        entry = self.lut.get(name)
+        if entry is not None:
+            return entry
         print("warning:  unexpected node-name %s" % name)
         return self.default
 
     def startElement(self, sh, name, attrs):
-        return self.get_case(name).handler
+        return self.get_entry(name)[1]
 
     def endElement(self, sh, name, spawned_handler):
-        if spawned_handler.result is None:
+        result = spawned_handler.result
+        if result is None:
             return
-        case = self.get_case(name)
-        case.apply_result(spawned_handler.result, self.child_results)
+        slot, handler, case = self.get_entry(name)
+        case.apply_result(result, self.child_results, slot)
 
     def goodbye(self, sh):
-        for case in self.cases.values():
-            case.final(self.child_results)
-        self.post_result(sh, self.child_results)
+        self.post_result(sh, self.table.final_results(self.child_results))
 
     def reclaim(self):
         self.result = None
-        self.child_results = dict()
-        self.init_child_results()
+        self.table.reset_results(self.child_results)
         return True
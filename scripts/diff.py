@@ -1,44 +1,70 @@
+from __future__ import print_function
 from koert.gnucash.tools import open_gcf
-from koert.gnucash.diff import GcStructDiff
+from koert.gnucash.diff import GcStructDiff, iter_changes, emit_text, \
+    emit_jsonl
+import argparse
 import os.path
 import sys
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare two gnucash files")
+    parser.add_argument("path_a", help="a path to the gnucash file")
+    parser.add_argument("path_b", help="a path to another gnucash file "
+                                       "to compare it with")
+    parser.add_argument("--format", choices=("tree", "text", "jsonl"),
+                        default="tree",
+                        help="tree prints one nested report at the end; "
+                             "text and jsonl print a line per change "
+                             "as soon as it is found")
+    parser.add_argument("--by-id", action="store_true",
+                        help="pair transactions only by GUID, and not "
+                             "also by date, num, amounts and accounts")
+    return parser.parse_args()
+
+
 def main():
-    if len(sys.argv) != 3:
-        print("Please provide (1) a path to the gnucash file"
-              " and (2) a path to another gnucash file"
-              " to compare it with.")
-        return
+    args = parse_args()
+    path_a, path_b = args.path_a, args.path_b
 
-    cmd, path_a, path_b = sys.argv
+    # with text and jsonl, stdout is only for the changes
+    log = sys.stdout if args.format == "tree" else sys.stderr
 
-    print("Comparing:")
-    print(" A. %s  with " % (path_a,))
-    print(" B. %s ;" % (path_b,))
-    print("")
+    print("Comparing:", file=log)
+    print(" A. %s  with " % (path_a,), file=log)
+    print(" B. %s ;" % (path_b,), file=log)
+    print("", file=log)
     if not os.path.exists(path_a):
-        print("File A does not exist")
+        print("File A does not exist", file=log)
         return
     if not os.path.exists(path_b):
-        print("File B does not exist")
+        print("File B does not exist", file=log)
         return
 
-    print("Loading A...  this may take a while...")
+    print("Loading A...  this may take a while...", file=log)
     A = open_gcf(path_a)
-    print("done.")
-    print("")
-    print("Loading B...")
+    print("done.", file=log)
+    print("", file=log)
+    print("Loading B...", file=log)
     B = open_gcf(path_b)
-    print("done.")
-    print("")
+    print("done.", file=log)
+    print("", file=log)
 
-    print("Computing difference...")
-    print("   '-x' means x is in A, but not B; it has been removed")
-    print("   '+x' means x is in B, but not A; it has been added")
+    print("Computing difference...", file=log)
+    if args.format == "jsonl":
+        emit_jsonl(iter_changes(A, B, match=not args.by_id), sys.stdout)
+        return
+    print("   '-x' means x is in A, but not B; it has been removed", file=log)
+    print("   '+x' means x is in B, but not A; it has been added", file=log)
+    if args.format == "text":
+        print("   '~x f: a -> b' means the field f of x has been changed",
+              file=log)
+        print("", file=log)
+        emit_text(iter_changes(A, B, match=not args.by_id), sys.stdout)
+        return
     print("   '~x' means x has been changed; the difference follows in ( )")
     print("")
-    print(GcStructDiff(A, B))
+    print(GcStructDiff(A, B, match=not args.by_id))
     print("")
     print("done.")
 
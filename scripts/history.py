@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+from koert.gnucash.history import history
+from koert.gnucash.tools import get_book_cache
+from koert.gnucash.diff import emit_text, jsonable, Change
+import argparse
+import json
+import sys
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="List the changes made to a gnucash file "
+                    "kept in a git repository, commit by commit")
+    parser.add_argument("repo", help="the path to the git repository")
+    parser.add_argument("path", help="the path to the gnucash file "
+                                     "in the repository")
+    parser.add_argument("rev", nargs="?", default="HEAD",
+                        help="the commits to go through, "
+                             "such as 'v1..master' (default: HEAD)")
+    parser.add_argument("--cache-dir", default=None,
+                        help="a directory to keep the parsed files in, "
+                             "so that they need not be parsed again")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="the number of processes parsing the files "
+                             "(default: one per cpu)")
+    parser.add_argument("--format", choices=("text", "jsonl"),
+                        default="text")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cache = None
+    if args.cache_dir is not None:
+        cache = get_book_cache(args.cache_dir)
+
+    out = sys.stdout
+    for rev in history(args.repo, args.path, args.rev,
+                       cache=cache, workers=args.workers):
+        if args.format == "jsonl":
+            _emit_jsonl(rev, out)
+        else:
+            _emit_text(rev, out)
+        out.flush()
+
+
+def _emit_text(rev, out):
+    commit = rev.commit
+    out.write("commit %s\n" % (commit.hexsha,))
+    out.write("Author: %s <%s>\n" % (commit.author.name, commit.author.email))
+    out.write("Date:   %s\n" % (commit.authored_datetime,))
+    out.write("\n    %s\n\n" % (commit.summary,))
+    if rev.changes is None:
+        out.write("(first version)\n")
+    else:
+        emit_text(rev.changes, out)
+    out.write("\n")
+
+
+def _emit_jsonl(rev, out):
+    for change in rev.changes or ():
+        record = dict((name, jsonable(value))
+                      for name, value in zip(Change._fields, change))
+        record["commit"] = rev.commit.hexsha
+        out.write(json.dumps(record, sort_keys=True))
+        out.write("\n")
+
+
+if __name__ == "__main__":
+    main()